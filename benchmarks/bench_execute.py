@@ -0,0 +1,124 @@
+"""Runs action_execute end to end against fake models and a fake SendGrid client.
+
+Run from the repository root with the deployment requirements installed:
+
+    python -m benchmarks.bench_execute [--rows 100 1000] [--columns 4 12] [--modes row row_batch all]
+        [--latency 0.2] [--jitter 0.1] [--error-rate 0.02] [--calls-per-minute 600]
+
+Nothing is sent to Vertex AI or SendGrid. Each run posts a synthetic Looker
+payload to action_execute and reports wall time, model calls, tokens, the time
+spent in each traced stage (rate limit wait is summed over the worker
+threads) and peak Python memory (tracemalloc, which itself
+slows the run, so compare runs with each other rather than with production).
+Pipeline output is silenced unless --verbose is given.
+"""
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import time
+import tracemalloc
+from unittest import mock
+from benchmarks.bench_row_encoding import sample_payload
+
+# read by palm_api and main at import, so set before they are imported below
+os.environ.setdefault('LOOKER_AUTH_TOKEN', 'benchmark')
+os.environ.setdefault('PREDICTION_CACHE', 'none')  # every run reaches the model
+os.environ.setdefault('TRACE_EXPORTER', 'memory')
+os.environ['EXECUTE_MODE'] = 'sync'
+
+STAGES = ['dispatch', 'reduce', 'render_html', 'sendgrid_send']
+
+
+class Request:
+    """The parts of a flask request that action_execute reads"""
+    method = 'POST'
+    headers = {'authorization': 'Token token="{}"'.format(os.environ['LOOKER_AUTH_TOKEN'])}
+
+    def __init__(self, body: dict):
+        self.body = body
+
+    def get_json(self):
+        return self.body
+
+
+def execute_request(rows: int, columns: int, mode: str) -> dict:
+    """Builds a Looker execute request with an attachment of rows x columns"""
+    dimensions = max(1, columns // 2)
+    data = sample_payload(rows, dimensions, columns - dimensions, 0.05)
+    return {
+        'attachment': {'mimetype': 'application/json', 'extension': 'json', 'data': json.dumps(data)},
+        'data': {'email': 'benchmark@example.com', 'user_id': '1'},
+        'form_params': {'question': 'What trends stand out?', 'row_or_all': mode, 'default_params': 'yes'},
+    }
+
+
+def run(body: dict, args) -> dict:
+    import instrumentation
+    import main
+    import palm_api
+    from benchmarks import fakes
+    from rate_limiter import AdaptiveRateLimiter
+
+    usage = fakes.Usage()
+    model = fakes.FakeModel(usage, latency=args.latency, jitter=args.jitter,
+                            error_rate=args.error_rate, output_tokens=args.output_tokens)
+    instrumentation.exporter.clear()
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    # a fresh limiter per run, so throttling in one run does not slow the next
+    rate_limiter = AdaptiveRateLimiter(palm_api.CALL_LIMIT, palm_api.ONE_MINUTE, burst=palm_api.MAX_WORKERS)
+    with fakes.installed(model, fakes.FakeSendGridClient(usage)), output, \
+            mock.patch.object(palm_api, 'rate_limiter', rate_limiter):
+        tracemalloc.start()
+        start = time.perf_counter()
+        response = main.action_execute(Request(body))
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    stages = {stage: sum(span.duration for span in instrumentation.exporter.finished_spans(stage))
+              for stage in STAGES}
+    waits = sum(span.attributes.get('rate_limit_wait_seconds', 0)
+                for span in instrumentation.exporter.finished_spans('model_call'))
+    return {'status': response.status_code, 'seconds': elapsed, 'peak_mb': peak / 2 ** 20,
+            'usage': usage, 'stages': stages, 'rate_limit_wait': waits}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument('--columns', type=int, nargs='+', default=[4, 12])
+    parser.add_argument('--modes', nargs='+', default=['row', 'row_batch', 'all'],
+                        choices=['row', 'row_batch', 'all'])
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds per model call')
+    parser.add_argument('--jitter', type=float, default=0.1, help='extra random seconds per model call')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of model calls that raise ResourceExhausted')
+    parser.add_argument('--output-tokens', type=int, default=50, help='length of each fake reply')
+    parser.add_argument('--calls-per-minute', type=int, default=6000,
+                        help='rate limit to pace calls at (the production default is 50)')
+    parser.add_argument('--verbose', action='store_true', help='show the pipeline output')
+    args = parser.parse_args()
+    os.environ.setdefault('MODEL_CALLS_PER_MINUTE', str(args.calls_per_minute))
+    with contextlib.redirect_stdout(io.StringIO()):
+        importlib.import_module('main')  # import once, outside the measured runs
+
+    print('{:<10} {:>7} {:>5} {:>6} {:>9} {:>7} {:>9} {:>11} {:>10} {:>9} {:>8} {:>10} {:>9} {:>9}'.format(
+        'mode', 'rows', 'cols', 'status', 'seconds', 'calls', 'throttled', 'prompt tok', 'dispatch',
+        'reduce', 'render', 'rate wait', 'email KB', 'peak MB'))
+    for rows in args.rows:
+        for columns in args.columns:
+            for mode in args.modes:
+                result = run(execute_request(rows, columns, mode), args)
+                usage = result['usage']
+                print('{:<10} {:>7} {:>5} {:>6} {:>9.2f} {:>7} {:>9} {:>11} {:>10.2f} {:>9.2f} {:>8.2f} {:>10.2f} {:>9.0f} {:>9.1f}'.format(
+                    mode, rows, columns, result['status'], result['seconds'], usage.model_calls,
+                    usage.throttled, usage.prompt_tokens, result['stages']['dispatch'],
+                    result['stages']['reduce'], result['stages']['render_html'], result['rate_limit_wait'],
+                    usage.email_chars / 1024, result['peak_mb']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Compares the streaming HTML table writer with the previous pandas to_html path.
+
+Run from the repository root with the dev packages installed (pandas is only
+needed for the comparison):
+
+    python -m benchmarks.bench_html_table [--rows 1000 10000 100000] [--columns 12]
+
+Every measurement runs in a fresh interpreter so peak RSS is not shared.
+Peak RSS is reported as the growth over the process size once the rows are
+built, i.e. the memory the renderer itself needed.
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+RENDERERS = ['utils.list_to_html', 'pandas.DataFrame.to_html']
+
+CHILD = '''
+import json
+import resource
+import time
+from benchmarks.bench_html_table import sample_rows, render
+
+rows = sample_rows({rows}, {columns})
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+html = render({renderer!r}, rows)
+elapsed = time.perf_counter() - start
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({{'seconds': elapsed, 'peak_rss_kb': after - before, 'chars': len(html)}}))
+'''
+
+
+def sample_rows(rows: int, columns: int) -> list:
+    """Builds Looker style rows with alternating string and numeric fields"""
+    return [{('orders.field_{}'.format(c)): ('value <{}> & {}'.format(i, c) if c % 2 else i * c + 0.5)
+             for c in range(columns)} for i in range(rows)]
+
+
+def render(renderer: str, rows: list) -> str:
+    if renderer == 'utils.list_to_html':
+        from utils import list_to_html
+        return list_to_html(rows)
+    import pandas as pd
+    return pd.DataFrame(data=rows).to_html().replace('\n', '')
+
+
+def measure(renderer: str, rows: int, columns: int) -> dict | None:
+    code = CHILD.format(renderer=renderer, rows=rows, columns=columns)
+    result = subprocess.run([sys.executable, '-c', code],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        print('{} failed: {}'.format(renderer, result.stderr.strip().splitlines()[-1]))
+        return None
+    return json.loads(result.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--columns', type=int, default=12)
+    args = parser.parse_args()
+
+    print('{:<26} {:>8} {:>10} {:>14} {:>12}'.format(
+        'renderer', 'rows', 'seconds', 'peak RSS (MB)', 'chars'))
+    for rows in args.rows:
+        for renderer in RENDERERS:
+            result = measure(renderer, rows, args.columns)
+            if result:
+                print('{:<26} {:>8} {:>10.3f} {:>14.1f} {:>12}'.format(
+                    renderer, rows, result['seconds'], result['peak_rss_kb'] / 1024, result['chars']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Measures the cold start import cost of each Cloud Function entry point.
+
+Run from the repository root with the deployment requirements installed:
+
+    python -m benchmarks.bench_import_time [--repeat 5] [--output times.json] [--baseline times.json]
+
+Each measurement runs in a fresh interpreter: it imports `main` and then does
+what the entry point does before its first response, i.e. calls action_list or
+action_form with a stub request, or loads the modules action_execute defers.
+With --baseline, entry points more than --tolerance slower than the saved
+run are reported and the script exits non-zero.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+REQUEST_STUB = '''
+class Request:
+    method = 'POST'
+    headers = {'authorization': 'Token token="benchmark"'}
+
+    def get_json(self):
+        return {'form_params': {}}
+'''
+
+ENTRY_POINTS = {
+    'action_list': 'main.action_list(Request())',
+    'action_form': 'main.action_form(Request())',
+    'action_execute': 'import palm_api, sendgrid, sendgrid.helpers.mail',
+}
+
+SNIPPET = '''
+import time
+start = time.perf_counter()
+import main
+{request_stub}
+{entry_point}
+print(time.perf_counter() - start)
+'''
+
+
+def measure(entry_point: str) -> float:
+    """Returns the seconds one fresh interpreter spends loading an entry point"""
+    code = SNIPPET.format(request_stub=REQUEST_STUB,
+                          entry_point=ENTRY_POINTS[entry_point])
+    env = dict(os.environ, LOOKER_AUTH_TOKEN='benchmark')
+    result = subprocess.run([sys.executable, '-c', code], env=env,
+                            capture_output=True, text=True, check=True)
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='write median seconds per entry point to this JSON file')
+    parser.add_argument('--baseline', help='compare against a JSON file written with --output')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown against the baseline (default 20%%)')
+    args = parser.parse_args()
+
+    results = {}
+    for entry_point in ENTRY_POINTS:
+        times = [measure(entry_point) for _ in range(args.repeat)]
+        results[entry_point] = statistics.median(times)
+        print('{:<16} median {:.3f}s  min {:.3f}s  max {:.3f}s'.format(
+            entry_point, results[entry_point], min(times), max(times)))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = [entry_point for entry_point, seconds in results.items()
+                       if entry_point in baseline and seconds > baseline[entry_point] * (1 + args.tolerance)]
+        for entry_point in regressions:
+            print('Regression: {} took {:.3f}s, baseline {:.3f}s'.format(
+                entry_point, results[entry_point], baseline[entry_point]))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""Compares prompt size of each row encoding on sample Looker JSON payloads.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_row_encoding [payload.json ...]
+
+Without arguments, synthetic payloads shaped like Looker `json` query results
+are used. Token counts use the same length based estimate as chunk planning.
+"""
+import json
+import random
+import sys
+from row_encoding import ROW_ENCODINGS, encode_rows, estimate_tokens
+
+PROMPT_BUDGET = int(8192 * 0.8)  # text-bison max input tokens, planned to at palm_api.INPUT_TOKEN_SHARE
+
+
+def sample_payload(rows: int, dimensions: int, measures: int, null_rate: float, seed: int = 0) -> list:
+    """Builds rows with dimension strings, numeric measures and some nulls"""
+    rng = random.Random(seed)
+    states = ['California', 'New York', 'Texas', 'Washington', 'Florida', None]
+    data = []
+    for i in range(rows):
+        row = {}
+        for d in range(dimensions):
+            row['users.dimension_{}'.format(d)] = (None if rng.random() < null_rate
+                                                   else '{} {}'.format(rng.choice(states), i % 17))
+        for m in range(measures):
+            row['order_items.measure_{}'.format(m)] = (None if rng.random() < null_rate
+                                                       else round(rng.uniform(0, 10000), 2))
+        data.append(row)
+    return data
+
+
+SAMPLES = {
+    'narrow (2 dims, 1 measure)': sample_payload(500, 2, 1, 0.05),
+    'wide (8 dims, 12 measures)': sample_payload(500, 8, 12, 0.05),
+    'sparse (4 dims, 6 measures, 40% null)': sample_payload(500, 4, 6, 0.4),
+}
+
+
+def main(paths: list):
+    samples = SAMPLES
+    if paths:
+        samples = {path: json.load(open(path)) for path in paths}
+
+    print('{:<40} {:<10} {:>10} {:>10} {:>12}'.format(
+        'payload', 'encoding', 'bytes', 'tokens', 'rows/prompt'))
+    for name, rows in samples.items():
+        baseline = None
+        for encoding in ROW_ENCODINGS:
+            text = encode_rows(rows, encoding)
+            size = len(text.encode('utf-8'))
+            tokens = estimate_tokens(text)
+            baseline = baseline or tokens
+            rows_per_prompt = int(PROMPT_BUDGET / (tokens / len(rows))) if rows else 0
+            print('{:<40} {:<10} {:>10} {:>10} {:>12}  ({:.0%} of json)'.format(
+                name, encoding, size, tokens, rows_per_prompt, tokens / baseline))
+        repr_tokens = estimate_tokens(repr(rows))
+        print('{:<40} {:<10} {:>10} {:>10} {:>12}  (previous prompt format)'.format(
+            name, 'repr', len(repr(rows).encode('utf-8')), repr_tokens,
+            int(PROMPT_BUDGET / (repr_tokens / len(rows))) if rows else 0))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
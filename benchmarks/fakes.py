@@ -0,0 +1,143 @@
+"""Local stand-ins for Vertex AI models and SendGrid, so the execute pipeline runs offline.
+
+    from benchmarks import fakes
+    usage = fakes.Usage()
+    with fakes.installed(fakes.FakeModel(usage, latency=0.2, error_rate=0.05), fakes.FakeSendGridClient(usage)):
+        main.action_execute(request)
+
+Token counts use the same length based estimate as chunk planning.
+"""
+import csv
+import io
+import json
+import random
+import threading
+import time
+from contextlib import contextmanager
+from unittest import mock
+from google.api_core import exceptions
+from model_types import MODEL_TYPES
+from row_encoding import CHARS_PER_TOKEN, estimate_tokens
+
+
+class Usage:
+    """Counts calls and tokens across every fake, shared by the worker threads"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.model_calls = 0
+        self.throttled = 0
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+        self.emails = 0
+        self.email_chars = 0
+
+    def add(self, **counts):
+        with self._lock:
+            for name, amount in counts.items():
+                setattr(self, name, getattr(self, name) + amount)
+
+
+class FakeResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+    def __str__(self):
+        return self.text
+
+
+def batch_row_numbers(content: str) -> list | None:
+    """Returns the row numbers in a batched per row prompt, or None for other prompts"""
+    if 'JSON array:' not in content:
+        return None
+    data = content.rsplit('```', 2)[-2]
+    try:
+        parsed = json.loads(data)
+    except json.JSONDecodeError:
+        delimiter = '\t' if '\t' in data.split('\n', 1)[0] else ','
+        return [int(row['row']) for row in csv.DictReader(io.StringIO(data), delimiter=delimiter)]
+    if isinstance(parsed, dict):  # columnar
+        index = parsed['columns'].index('row')
+        return [values[index] for values in parsed['rows']]
+    return [row['row'] for row in parsed]
+
+
+class FakeModel:
+    """Stands in for TextGenerationModel and CodeGenerationModel.
+
+    Each predict sleeps `latency` seconds (plus up to `jitter`), raises
+    ResourceExhausted with probability `error_rate`, and rejects prompts over
+    the model's input token limit as Vertex AI does. Replies are
+    `output_tokens` long, or a JSON answer per row for batched per row prompts.
+    """
+
+    def __init__(self,
+                 usage: Usage,
+                 model_type: str = 'text-bison',
+                 latency: float = 0.0,
+                 jitter: float = 0.0,
+                 error_rate: float = 0.0,
+                 output_tokens: int = 50,
+                 seed: int = 0
+                 ):
+        self.usage = usage
+        self.model_type = model_type
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.output_tokens = output_tokens
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def predict(self, content: str, temperature: float = 0.2, max_output_tokens: int = 1024,
+                top_k: int | None = None, top_p: float | None = None) -> FakeResponse:
+        with self._lock:
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            throttled = self._random.random() < self.error_rate
+        time.sleep(delay)
+        if throttled:
+            self.usage.add(throttled=1)
+            raise exceptions.ResourceExhausted('Fake quota exceeded')
+
+        prompt_tokens = estimate_tokens(content)
+        if prompt_tokens > MODEL_TYPES[self.model_type]['max_input_tokens']:
+            raise exceptions.InvalidArgument('Prompt has {} tokens, the limit is {}'.format(
+                prompt_tokens, MODEL_TYPES[self.model_type]['max_input_tokens']))
+
+        rows = batch_row_numbers(content)
+        if rows is None:
+            text = ('insight ' * self.output_tokens)[:min(self.output_tokens, max_output_tokens) * CHARS_PER_TOKEN]
+        else:
+            text = json.dumps([{'row': row, 'answer': 'answer {}'.format(row)} for row in rows])
+        self.usage.add(model_calls=1, prompt_tokens=prompt_tokens, output_tokens=estimate_tokens(text))
+        return FakeResponse(text)
+
+
+class FakeSendGridResponse:
+    status_code = 202
+
+
+class FakeSendGridClient:
+    """Stands in for SendGridAPIClient, recording the size of each message instead of sending it"""
+
+    def __init__(self, usage: Usage, latency: float = 0.0):
+        self.usage = usage
+        self.latency = latency
+
+    def __call__(self, api_key=None):
+        return self  # called like the SendGridAPIClient constructor
+
+    def send(self, message) -> FakeSendGridResponse:
+        time.sleep(self.latency)
+        self.usage.add(emails=1, email_chars=len(json.dumps(message.get())))
+        return FakeSendGridResponse()
+
+
+@contextmanager
+def installed(model: FakeModel, sendgrid_client: FakeSendGridClient):
+    """Routes palm_api's model handles and sendgrid's client to the fakes while active"""
+    import palm_api
+    import sendgrid
+    with mock.patch.object(palm_api, 'get_model', lambda model_type: model), \
+            mock.patch.object(sendgrid, 'SendGridAPIClient', sendgrid_client):
+        yield
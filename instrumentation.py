@@ -0,0 +1,213 @@
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+# Spans time the stages of a request (parsing, chunking, model calls, reduce,
+# rendering, sending). Finished spans go to the exporter selected by
+# TRACE_EXPORTER: json (structured log lines), otel (OpenTelemetry API),
+# memory (kept in a list, for tests) or none.
+
+_current_span = contextvars.ContextVar('current_span', default=None)
+_timers = threading.local()
+
+
+class Span:
+    """A timed stage of a request, with attributes and a parent span"""
+
+    def __init__(self, name: str, parent: 'Span | None', attributes: dict):
+        self.name = name
+        self.parent = parent
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.attributes = dict(attributes)
+        self.start = time.time()
+        self.duration = None
+        self.status = 'ok'
+        self.error = None
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def set(self, **attributes):
+        """Sets attributes on the span"""
+        with self._lock:
+            self.attributes.update(attributes)
+
+    def add(self, attribute: str, amount: float = 1):
+        """Adds to a numeric attribute, e.g. a counter or accumulated seconds"""
+        with self._lock:
+            self.attributes[attribute] = self.attributes.get(
+                attribute, 0) + amount
+
+    def end(self):
+        self.duration = time.perf_counter() - self._started
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent.span_id if self.parent else None,
+            'start': self.start,
+            'duration_ms': round(self.duration * 1000, 3) if self.duration is not None else None,
+            'status': self.status,
+            'error': self.error,
+            'attributes': self.attributes,
+        }
+
+
+class Exporter:
+    """Receives spans as they start and end"""
+
+    def on_start(self, span: Span):
+        pass
+
+    def on_end(self, span: Span):
+        pass
+
+
+class JsonLogExporter(Exporter):
+    """Prints each finished span as one JSON line, which Cloud Logging parses as a structured entry"""
+
+    def on_end(self, span):
+        entry = span.to_dict()
+        entry['severity'] = 'ERROR' if span.status == 'error' else 'INFO'
+        entry['message'] = 'span {} took {}ms'.format(
+            span.name, entry['duration_ms'])
+        print(json.dumps(entry, default=str))
+
+
+class InMemoryExporter(Exporter):
+    """Keeps finished spans in memory, for tests and benchmarks"""
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def on_end(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def finished_spans(self, name: str | None = None) -> list:
+        with self._lock:
+            return [span for span in self.spans if name is None or span.name == name]
+
+    def clear(self):
+        with self._lock:
+            self.spans = []
+
+
+class OpenTelemetryExporter(Exporter):
+    """Mirrors spans onto the OpenTelemetry API, exported by whatever SDK the process configures"""
+
+    def __init__(self):
+        from opentelemetry import trace  # optional dependency, only needed for the otel exporter
+        self.trace = trace
+        self.tracer = trace.get_tracer('vertex-ai-actions')
+
+    def on_start(self, span):
+        parent = getattr(span.parent, 'otel_span', None)
+        context = self.trace.set_span_in_context(parent) if parent else None
+        span.otel_span = self.tracer.start_span(
+            span.name, context=context, start_time=int(span.start * 1e9))
+
+    def on_end(self, span):
+        otel_span = span.otel_span
+        otel_span.set_attributes({key: value for key, value in span.attributes.items()
+                                  if isinstance(value, (str, bool, int, float))})
+        if span.status == 'error':
+            otel_span.set_status(self.trace.Status(
+                self.trace.StatusCode.ERROR, span.error))
+        otel_span.end(end_time=int((span.start + span.duration) * 1e9))
+
+
+def create_exporter(backend: str | None = None) -> Exporter:
+    """Creates the exporter selected by TRACE_EXPORTER (json, otel, memory or none)"""
+    backend = backend or os.environ.get('TRACE_EXPORTER', 'json')
+    if backend == 'json':
+        return JsonLogExporter()
+    if backend == 'otel':
+        return OpenTelemetryExporter()
+    if backend == 'memory':
+        return InMemoryExporter()
+    if backend == 'none':
+        return Exporter()
+    raise ValueError('Unknown trace exporter: {}'.format(backend))
+
+
+exporter = create_exporter()
+
+
+def set_exporter(new_exporter: Exporter):
+    """Replaces the exporter, e.g. with an InMemoryExporter in tests"""
+    global exporter
+    exporter = new_exporter
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Times the enclosed block as a child of the current span"""
+    new_span = Span(name, _current_span.get(), attributes)
+    token = _current_span.set(new_span)
+    exporter.on_start(new_span)
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span.status = 'error'
+        new_span.error = repr(e)
+        raise
+    finally:
+        new_span.end()
+        _current_span.reset(token)
+        exporter.on_end(new_span)
+
+
+def traced(name: str):
+    """Decorator that runs each call of the function in a new span"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def current_span() -> Span | None:
+    return _current_span.get()
+
+
+def propagate(fn):
+    """Wraps fn so that calls from worker threads nest their spans under the caller's current span"""
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.copy().run(fn, *args, **kwargs)
+    return run
+
+
+def timed_iter(iterable, target: Span, attribute: str):
+    """Yields from iterable, adding the seconds spent producing items to an attribute of target"""
+    iterator = iter(iterable)
+    stack = getattr(_timers, 'stack', None)
+    if stack is None:
+        stack = _timers.stack = []
+    while True:
+        nested = [0.0]
+        stack.append(nested)
+        started = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            elapsed = time.perf_counter() - started
+            stack.pop()
+            target.add(attribute, elapsed - nested[0])
+            if stack:
+                stack[-1][0] += elapsed
+        yield item
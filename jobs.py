@@ -0,0 +1,337 @@
+import hashlib
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+
+DEFAULT_CHECKPOINT_TTL = 24 * 60 * 60  # One day in seconds, checkpoints of runs not retried by then are removed
+SWEEP_INTERVAL = 60 * 60  # Seconds between sweeps of expired files on an instance
+
+# Queued execute jobs. action_execute persists the Looker request as a job and
+# publishes its id; action_worker loads the job, records each completed chunk
+# so a crashed or timed out run resumes where it stopped, and deletes the job
+# once the report is sent.
+#
+# Synchronous runs checkpoint their completed chunks in the same kind of store,
+# keyed by a hash of the request, so running the same request again after some
+# chunks failed only sends the failed ones.
+
+
+def new_job_id() -> str:
+    """Returns a unique id for a job"""
+    return uuid.uuid4().hex
+
+
+def run_id(request_json: dict) -> str:
+    """Returns an id shared by every execute request for the same data, prompt and parameters"""
+    run = {'data': request_json['attachment']['data'],
+           'form_params': request_json['form_params']}
+    return hashlib.sha256(json.dumps(run, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class JobStore:
+    """Interface for storing job descriptors and their completed chunks"""
+
+    def save(self, job_id: str, job: dict):
+        raise NotImplementedError
+
+    def load(self, job_id: str) -> dict | None:
+        """Returns the job descriptor, or None if the job does not exist"""
+        raise NotImplementedError
+
+    def save_progress(self, job_id: str, chunk: int, result: str):
+        """Records the model result of a completed chunk"""
+        raise NotImplementedError
+
+    def load_progress(self, job_id: str) -> dict:
+        """Returns a dict of completed chunk indexes and their results"""
+        raise NotImplementedError
+
+    def delete(self, job_id: str):
+        raise NotImplementedError
+
+
+class MemoryJobStore(JobStore):
+    """Job store held in process memory, for local testing"""
+
+    def __init__(self):
+        self._jobs = {}
+        self._progress = {}
+        self._lock = threading.Lock()
+
+    def save(self, job_id, job):
+        with self._lock:
+            self._jobs[job_id] = job
+
+    def load(self, job_id):
+        return self._jobs.get(job_id)
+
+    def save_progress(self, job_id, chunk, result):
+        with self._lock:
+            self._progress.setdefault(job_id, {})[chunk] = result
+
+    def load_progress(self, job_id):
+        return dict(self._progress.get(job_id, {}))
+
+    def delete(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+            self._progress.pop(job_id, None)
+
+
+class FileJobStore(JobStore):
+    """Job store in a local directory, with progress appended one JSON line per chunk"""
+
+    def __init__(self, directory: str, ttl: float | None = None):
+        self.directory = directory
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._swept = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    def sweep(self):
+        """Removes the files of jobs not written to for ttl seconds. Returns the number removed."""
+        self._swept = time.time()
+        cutoff = self._swept - self.ttl
+        removed = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                pass  # removed by another process
+        if removed:
+            print('Removed {} expired files from {}'.format(removed, self.directory))
+        return removed
+
+    def _path(self, job_id, suffix):
+        return os.path.join(self.directory, job_id + suffix)
+
+    def save(self, job_id, job):
+        with open(self._path(job_id, '.json'), 'w') as f:
+            json.dump(job, f)
+
+    def load(self, job_id):
+        try:
+            with open(self._path(job_id, '.json')) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save_progress(self, job_id, chunk, result):
+        line = json.dumps({'chunk': chunk, 'result': result}) + '\n'
+        with self._lock, open(self._path(job_id, '.progress.jsonl'), 'a') as f:
+            f.write(line)
+
+    def load_progress(self, job_id):
+        if self.ttl is not None and time.time() - self._swept >= min(self.ttl, SWEEP_INTERVAL):
+            self.sweep()
+        progress = {}
+        try:
+            with open(self._path(job_id, '.progress.jsonl')) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        break  # partial line written when the last run was killed
+                    progress[entry['chunk']] = entry['result']
+        except FileNotFoundError:
+            pass
+        return progress
+
+    def delete(self, job_id):
+        for suffix in ('.json', '.progress.jsonl'):
+            try:
+                os.remove(self._path(job_id, suffix))
+            except FileNotFoundError:
+                pass
+
+
+class GCSJobStore(JobStore):
+    """Job store in a Cloud Storage bucket, shared by every Cloud Function instance"""
+
+    def __init__(self, bucket: str, prefix: str = 'jobs/'):
+        from google.cloud import storage
+        self.bucket = storage.Client().bucket(bucket)
+        self.prefix = prefix
+
+    def save(self, job_id, job):
+        self.bucket.blob('{}{}/job.json'.format(self.prefix, job_id)).upload_from_string(
+            json.dumps(job), content_type='application/json')
+
+    def load(self, job_id):
+        blob = self.bucket.blob('{}{}/job.json'.format(self.prefix, job_id))
+        if not blob.exists():
+            return None
+        return json.loads(blob.download_as_text())
+
+    def save_progress(self, job_id, chunk, result):
+        self.bucket.blob('{}{}/chunks/{}.json'.format(self.prefix, job_id, chunk)).upload_from_string(
+            json.dumps(result), content_type='application/json')
+
+    def load_progress(self, job_id):
+        progress = {}
+        for blob in self.bucket.list_blobs(prefix='{}{}/chunks/'.format(self.prefix, job_id)):
+            chunk = int(blob.name.rsplit('/', 1)[1].split('.')[0])
+            progress[chunk] = json.loads(blob.download_as_text())
+        return progress
+
+    def delete(self, job_id):
+        for blob in self.bucket.list_blobs(prefix='{}{}/'.format(self.prefix, job_id)):
+            blob.delete()
+
+
+class JobQueue:
+    """Interface for queues of job ids waiting for a worker"""
+
+    def publish(self, job_id: str):
+        raise NotImplementedError
+
+    def pull(self) -> str | None:
+        """Returns the next job id, or None if the queue is empty. Only local queues support pulling."""
+        raise NotImplementedError
+
+
+class MemoryQueue(JobQueue):
+    """Queue held in process memory, for local testing"""
+
+    def __init__(self):
+        self._queue = queue.Queue()
+
+    def publish(self, job_id):
+        self._queue.put(job_id)
+
+    def pull(self):
+        try:
+            return self._queue.get_nowait()
+        except queue.Empty:
+            return None
+
+
+class FileQueue(JobQueue):
+    """Queue of message files in a local directory, shared by processes on one machine"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def publish(self, job_id):
+        name = '{:020d}-{}'.format(time.time_ns(), job_id)
+        tmp_path = os.path.join(self.directory, '.' + name)
+        with open(tmp_path, 'w') as f:
+            f.write(job_id)
+        os.rename(tmp_path, os.path.join(self.directory, name))
+
+    def pull(self):
+        for name in sorted(os.listdir(self.directory)):
+            if name.startswith('.'):
+                continue
+            claimed_path = os.path.join(self.directory, '.claimed-' + name)
+            try:
+                # rename is atomic, so only one consumer claims each message
+                os.rename(os.path.join(self.directory, name), claimed_path)
+            except FileNotFoundError:
+                continue
+            with open(claimed_path) as f:
+                job_id = f.read()
+            os.remove(claimed_path)
+            return job_id
+        return None
+
+
+class PubSubQueue(JobQueue):
+    """Queue on a Pub/Sub topic, delivered to action_worker by a Pub/Sub trigger"""
+
+    def __init__(self, topic: str):
+        from google.cloud import pubsub_v1  # optional dependency, only needed for pubsub queues
+        self.publisher = pubsub_v1.PublisherClient()
+        self.topic = topic if topic.startswith('projects/') else self.publisher.topic_path(
+            os.environ.get('PROJECT'), topic)
+
+    def publish(self, job_id):
+        self.publisher.publish(self.topic, job_id.encode('utf-8')).result()
+
+
+def create_job_store(backend: str | None = None) -> JobStore:
+    """Creates the job store selected by JOB_STORE (gcs, file or memory)"""
+    backend = backend or os.environ.get('JOB_STORE', 'gcs')
+    if backend == 'gcs':
+        return GCSJobStore(os.environ['JOB_BUCKET'])
+    if backend == 'file':
+        return FileJobStore(os.environ.get('JOB_DIR', '/tmp/vertex-ai-jobs'))
+    if backend == 'memory':
+        return MemoryJobStore()
+    raise ValueError('Unknown job store: {}'.format(backend))
+
+
+def create_checkpoint_store(backend: str | None = None) -> JobStore | None:
+    """Creates the checkpoint store selected by CHECKPOINT_STORE (file, gcs, memory or none)"""
+    backend = backend or os.environ.get('CHECKPOINT_STORE', 'file')
+    if backend == 'file':
+        return FileJobStore(os.environ.get('CHECKPOINT_DIR', '/tmp/vertex-ai-checkpoints'),
+                            float(os.environ.get('CHECKPOINT_TTL', DEFAULT_CHECKPOINT_TTL)))
+    if backend == 'gcs':
+        return GCSJobStore(os.environ['JOB_BUCKET'], prefix='checkpoints/')
+    if backend == 'memory':
+        return MemoryJobStore()
+    if backend == 'none':
+        return None
+    raise ValueError('Unknown checkpoint store: {}'.format(backend))
+
+
+def create_job_queue(backend: str | None = None) -> JobQueue:
+    """Creates the job queue selected by JOB_QUEUE (pubsub, file or memory)"""
+    backend = backend or os.environ.get('JOB_QUEUE', 'pubsub')
+    if backend == 'pubsub':
+        return PubSubQueue(os.environ['JOB_TOPIC'])
+    if backend == 'file':
+        return FileQueue(os.environ.get('JOB_QUEUE_DIR', '/tmp/vertex-ai-queue'))
+    if backend == 'memory':
+        return MemoryQueue()
+    raise ValueError('Unknown job queue: {}'.format(backend))
+
+
+_job_store = None
+_job_queue = None
+_checkpoint_store = None
+
+
+def get_job_store() -> JobStore:
+    """Returns the job store for this instance, creating it on first use"""
+    global _job_store
+    if _job_store is None:
+        _job_store = create_job_store()
+    return _job_store
+
+
+def get_checkpoint_store() -> JobStore | None:
+    """Returns the checkpoint store for this instance, creating it on first use"""
+    global _checkpoint_store
+    if _checkpoint_store is None:
+        _checkpoint_store = create_checkpoint_store()
+    return _checkpoint_store
+
+
+def get_job_queue() -> JobQueue:
+    """Returns the job queue for this instance, creating it on first use"""
+    global _job_queue
+    if _job_queue is None:
+        _job_queue = create_job_queue()
+    return _job_queue
+
+
+def drain(job_queue: JobQueue, handler):
+    """Runs handler on every job id waiting in a local queue, requeueing a job whose handler raises"""
+    handled = 0
+    while (job_id := job_queue.pull()) is not None:
+        try:
+            handler(job_id)
+        except Exception:
+            job_queue.publish(job_id)
+            raise
+        handled += 1
+    return handled
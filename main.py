@@ -1,16 +1,106 @@
+import base64
+import html
+import importlib.util
 import json
 import os
-from flask import Response
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
-from icon import icon_data_uri
-from utils import authenticate, handle_error, list_to_html, safe_cast, sanitize_and_load_json_str
-from palm_api import model_with_limit_and_backoff, reduce, MODEL_TYPES, DEFAULT_MODEL_TYPE
+import time
+import jobs
+from instrumentation import current_span, span, timed_iter, traced
+from startup import timed, startup_report
+with timed('import flask'):
+    from flask import Response
+from utils import authenticate, cached_json_response, dedupe_rows, etag, handle_error, iter_json_rows, list_to_html, project_rows, rows_to_csv_gz, rows_to_parquet, safe_cast
+from model_types import MODEL_TYPES, DEFAULT_MODEL_TYPE
+from row_encoding import ROW_ENCODINGS, DEFAULT_ROW_ENCODING, get_columns
+
+# Heavy dependencies (icon data, vertexai, sendgrid) are imported inside
+# the entry points that use them, so each Cloud Function only loads what it needs.
 
 
 BASE_DOMAIN = 'https://{}-{}.cloudfunctions.net/{}-'.format(os.environ.get(
     'REGION'), os.environ.get('PROJECT'), os.environ.get('ACTION_NAME'))
 
+# 'sync' runs the model inside the execute request, 'async' queues a job for action_worker
+EXECUTE_MODE = os.environ.get('EXECUTE_MODE', 'sync')
+# Times action_worker runs a job before giving up on it, as Pub/Sub retries for up to 7 days
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+
+# 'inline' puts the result table in the email body, 'attachment' attaches it as
+# a compressed file with a preview in the body, 'auto' attaches large results
+REPORT_DELIVERY = os.environ.get('REPORT_DELIVERY', 'auto')
+REPORT_INLINE_MAX_ROWS = int(os.environ.get('REPORT_INLINE_MAX_ROWS', 500))
+# Size of the query results as sent by Looker, a proxy for the size of the table
+REPORT_INLINE_MAX_BYTES = int(os.environ.get('REPORT_INLINE_MAX_BYTES', 1000000))
+REPORT_ATTACHMENT_FORMAT = os.environ.get('REPORT_ATTACHMENT_FORMAT', 'csv')
+REPORT_PREVIEW_ROWS = 20  # Rows shown in the body when the table is attached
+
+ATTACHMENT_FORMATS = {
+    'csv': {'writer': rows_to_csv_gz, 'extension': 'csv.gz', 'mimetype': 'application/gzip', 'requires': None},
+    'parquet': {'writer': rows_to_parquet, 'extension': 'parquet', 'mimetype': 'application/vnd.apache.parquet', 'requires': 'pyarrow'},
+}
+
+
+
+def report_settings_problem(delivery, attachment_format):
+    """Returns why the report delivery settings cannot be used, or None if they can"""
+    if delivery not in ('auto', 'inline', 'attachment'):
+        return 'Unknown report delivery: {}'.format(delivery)
+    if attachment_format not in ATTACHMENT_FORMATS:
+        return 'Unknown report attachment format: {}'.format(attachment_format)
+    requires = ATTACHMENT_FORMATS[attachment_format]['requires']
+    if requires and importlib.util.find_spec(requires) is None:
+        return 'Report attachment format {} requires adding {} to requirements.txt'.format(
+            attachment_format, requires)
+    return None
+
+
+# a bad setting must not take down the list and form endpoints, so reports fall back to inline tables
+_report_settings_problem = report_settings_problem(REPORT_DELIVERY, REPORT_ATTACHMENT_FORMAT)
+if _report_settings_problem is not None:
+    print('Warning: {}. Result tables will be sent inline.'.format(_report_settings_problem))
+    REPORT_DELIVERY = 'inline'
+
+
+# Cache-Control for the list and form responses. Both carry an ETag, so a
+# client sending If-None-Match gets an empty 304 when nothing changed.
+LIST_CACHE_CONTROL = 'private, max-age=300'
+FORM_CACHE_CONTROL = 'private, no-cache'
+
+# The list response never changes on an instance, so it is serialized once
+_list_response = None
+
+
+def list_response():
+    """Returns the action hub list JSON and its ETag, serialized on first use"""
+    global _list_response
+    if _list_response is None:
+        with timed('import icon'):
+            from icon import icon_data_uri
+
+        response = {
+            'label': 'Looker Vertex AI [DEV]',
+            'integrations': [{
+                'name': os.environ.get('ACTION_NAME'),
+                'label': os.environ.get('ACTION_LABEL'),
+                'supported_action_types': ['query'],
+                "icon_data_uri": icon_data_uri,
+                'form_url': BASE_DOMAIN + 'form',
+                'url': BASE_DOMAIN + 'execute',
+                'supported_formats': ['json'],
+                'supported_formattings': ['formatted'],
+                'supported_visualization_formattings': ['noapply'],
+                'params': [
+                    {'name': 'email', 'label': 'Email',
+                        'user_attribute_name': 'email', 'required': True},
+                    {'name': 'user_id', 'label': 'User ID',
+                        'user_attribute_name': 'id', 'required': True}
+                ]
+            }]
+        }
+        body = json.dumps(response)
+        _list_response = body, etag(body)
+    return _list_response
+
 
 # https://github.com/looker-open-source/actions/blob/master/docs/action_api.md#actions-list-endpoint
 def action_list(request):
@@ -19,58 +109,23 @@ def action_list(request):
     if auth.status_code != 200:
         return auth
 
-    response = {
-        'label': 'Looker Vertex AI [DEV]',
-        'integrations': [{
-            'name': os.environ.get('ACTION_NAME'),
-            'label': os.environ.get('ACTION_LABEL'),
-            'supported_action_types': ['query'],
-            "icon_data_uri": icon_data_uri,
-            'form_url': BASE_DOMAIN + 'form',
-            'url': BASE_DOMAIN + 'execute',
-            'supported_formats': ['json'],
-            'supported_formattings': ['formatted'],
-            'supported_visualization_formattings': ['noapply'],
-            'params': [
-                {'name': 'email', 'label': 'Email',
-                    'user_attribute_name': 'email', 'required': True},
-                {'name': 'user_id', 'label': 'User ID',
-                    'user_attribute_name': 'id', 'required': True}
-            ]
-        }]
-    }
-
+    body, body_etag = list_response()
     print('returning integrations json')
-    return Response(json.dumps(response), status=200, mimetype='application/json')
-
-
-# https://github.com/looker-open-source/actions/blob/master/docs/action_api.md#action-form-endpoint
-def action_form(request):
-    """Return form endpoint data for action"""
-    auth = authenticate(request)
-    if auth.status_code != 200:
-        return auth
+    return cached_json_response(request, body, body_etag, LIST_CACHE_CONTROL)
 
-    request_json = request.get_json()
-    form_params = request_json['form_params']
-    print(form_params)
 
-    default_question = 'Can you summarize the following dataset in 10 bullet points?'
-    if 'question' in form_params:
-        default_question = form_params['question']
+# Form fields whose default is whatever the user last submitted
+FORM_DEFAULTS = {
+    'question': 'Can you summarize the following dataset in 10 bullet points?',
+    'row_or_all': 'all',
+    'prompt_columns': '',
+    'default_params': 'yes',
+    'model_type': ''
+}
 
-    default_row_or_all = 'all'
-    if 'row_or_all' in form_params:
-        default_row_or_all = form_params['row_or_all']
-
-    default_params = 'yes'
-    if 'default_params' in form_params:
-        default_params = form_params['default_params']
-
-    default_model_type = ''
-    if 'model_type' in form_params:
-        default_model_type = form_params['model_type']
 
+def build_form(custom_params, model_chosen, text_model):
+    """Builds the form fields shown for a combination of the interactive params"""
     # step 1 - select a prompt
     response = [{
         'name': 'question',
@@ -78,17 +133,26 @@ def action_form(request):
         'description': 'Type your prompt to generate a model response.',
         'type': 'textarea',
         'required': True,
-        "default":  default_question
+        "default":  FORM_DEFAULTS['question']
     },
         {
         'name': 'row_or_all',
         'label': 'Run per row or all results?',
-        'description': "Choose whether to run the model on all the results together, or, individually per row.",
+        'description': "Choose whether to run the model on all the results together, or, individually per row. Batched sends several rows per model call, which is faster on large results.",
         'type': 'select',
         'required': True,
-        "default":  default_row_or_all,
+        "default":  FORM_DEFAULTS['row_or_all'],
         'options': [{'name': 'all', 'label': 'All Results'},
-                    {'name': 'row', 'label': 'Per Row'}],
+                    {'name': 'row', 'label': 'Per Row'},
+                    {'name': 'row_batch', 'label': 'Per Row (Batched)'}],
+    },
+        {
+        'name': 'prompt_columns',
+        'label': 'Fields to send (optional)',
+        'description': 'Comma separated field names, e.g. users.state, orders.count, to send to the model. Leave blank to send every field. Per row, rows with the same values in these fields are only run once.',
+        'type': 'text',
+        'required': False,
+        "default":  FORM_DEFAULTS['prompt_columns']
     },
         {
         'name': 'default_params',
@@ -96,30 +160,35 @@ def action_form(request):
         'description': "Select 'no' to customize text model parameters.",
         'type': 'select',
         'required': True,
-        "default":  default_params,
+        "default":  FORM_DEFAULTS['default_params'],
         'options': [{'name': 'yes', 'label': 'Yes'},
                     {'name': 'no', 'label': 'No'}],
         'interactive': True  # dynamic field for model specific options
     }]
 
     # step 2 - optional - choose model type
-    if ('default_params' in form_params and
-            form_params['default_params'] == 'no'):
+    if custom_params:
         response.extend([{
             'name': 'model_type',
             'label': 'Model Type',
             'type': 'select',
-            'default': default_model_type,
+            'default': FORM_DEFAULTS['model_type'],
             'options': [{'name': MODEL_TYPES['text-bison']['name'], 'label': MODEL_TYPES['text-bison']['label']},
                         {'name': MODEL_TYPES['code-bison']['name'], 'label': MODEL_TYPES['code-bison']['label']}],
             'interactive': True
+        },
+            {
+            'name': 'row_encoding',
+            'label': 'Data Format',
+            'description': 'How rows are written into the prompt. Compact formats fit more rows per model call.',
+            'type': 'select',
+            'default': DEFAULT_ROW_ENCODING,
+            'options': [{'name': encoding['name'], 'label': encoding['label']} for encoding in ROW_ENCODINGS.values()]
         }
         ])
 
     # step 3a - optional - customize model params used by both models
-    if ('default_params' in form_params and
-            form_params['default_params'] == 'no' and
-            'model_type' in form_params):
+    if custom_params and model_chosen:
         response.extend([{
             'name': 'temperature',
             'label': 'Temperature',
@@ -137,10 +206,7 @@ def action_form(request):
         ])
 
     # step 3b - optional - customize model params used by text-bison
-    if ('default_params' in form_params and
-            form_params['default_params'] == 'no' and
-            'model_type' in form_params and
-            form_params['model_type'] == DEFAULT_MODEL_TYPE):
+    if custom_params and model_chosen and text_model:
         response.extend([{
             'name': 'top_k',
             'label': 'Top-k',
@@ -157,8 +223,47 @@ def action_form(request):
         }
         ])
 
-    print('returning form json: {}'.format(json.dumps(response)))
-    return Response(json.dumps(response), status=200, mimetype='application/json')
+    return response
+
+
+# Form variants built on this instance, keyed by which optional steps they show
+_form_variants = {}
+
+
+def form_variant(form_params):
+    """Returns the form fields for form_params, built once per instance and serialized except FORM_DEFAULTS fields"""
+    custom_params = form_params.get('default_params') == 'no'
+    key = (custom_params,
+           custom_params and 'model_type' in form_params,
+           custom_params and form_params.get('model_type') == DEFAULT_MODEL_TYPE)
+    if key not in _form_variants:
+        _form_variants[key] = [field if field['name'] in FORM_DEFAULTS else json.dumps(field)
+                               for field in build_form(*key)]
+    return _form_variants[key]
+
+
+# https://github.com/looker-open-source/actions/blob/master/docs/action_api.md#action-form-endpoint
+def action_form(request):
+    """Return form endpoint data for action"""
+    auth = authenticate(request)
+    if auth.status_code != 200:
+        return auth
+
+    request_json = request.get_json()
+    form_params = request_json['form_params']
+    print(form_params)
+
+    fields = []
+    for field in form_variant(form_params):
+        if not isinstance(field, str):
+            # the user's last input is the new default
+            field = json.dumps(dict(field, default=form_params.get(
+                field['name'], FORM_DEFAULTS[field['name']])))
+        fields.append(field)
+    body = '[' + ', '.join(fields) + ']'
+
+    print('returning form json with {} fields'.format(len(fields)))
+    return cached_json_response(request, body, etag(body), FORM_CACHE_CONTROL)
 
 
 # https://github.com/looker-open-source/actions/blob/master/docs/action_api.md#action-execute-endpoint
@@ -169,6 +274,136 @@ def action_execute(request):
         return auth
 
     request_json = request.get_json()
+    if EXECUTE_MODE == 'async':
+        error = validate_execute_request(request_json)
+        if error:
+            return handle_error(error, 400)
+        # acknowledge Looker right away, action_worker runs the job
+        job_id = submit_job(request_json)
+        print('Queued job {}'.format(job_id))
+        return Response(status=200, mimetype='application/json')
+
+    return execute_job(request_json)
+
+
+def validate_execute_request(request_json):
+    """Returns an error message if an execute request is missing required fields"""
+    if not isinstance(request_json, dict):
+        return 'Request body must be JSON'
+    attachment = request_json.get('attachment') or {}
+    form_params = request_json.get('form_params') or {}
+    action_params = request_json.get('data') or {}
+    if 'data' not in attachment:
+        return 'Request has no query results attached'
+    if not form_params.get('question'):
+        return 'Request has no prompt'
+    if form_params.get('row_or_all') not in ('row', 'row_batch', 'all'):
+        return 'Request must run per row or on all results'
+    if 'model_type' in form_params and form_params['model_type'] not in MODEL_TYPES:
+        return 'Unknown model type: {}'.format(form_params['model_type'])
+    if not action_params.get('email'):
+        return 'Request has no email address'
+    return None
+
+
+def submit_job(request_json):
+    """Persists an execute request as a job and queues it for action_worker"""
+    job_id = jobs.new_job_id()
+    jobs.get_job_store().save(
+        job_id, {'request': request_json, 'created': time.time()})
+    jobs.get_job_queue().publish(job_id)
+    return job_id
+
+
+# Pub/Sub triggered background function, deployed with --trigger-topic
+def action_worker(event, context):
+    """Process an execute job queued by action_execute"""
+    job_id = base64.b64decode(event['data']).decode('utf-8')
+    run_job(job_id)
+
+
+def run_job(job_id):
+    """Runs a queued job, raising on transient send failures so Pub/Sub delivers it again"""
+    job_store = jobs.get_job_store()
+    job = job_store.load(job_id)
+    if job is None:
+        print('Job {} not found, it may already be finished'.format(job_id))
+        return
+    attempts = job.get('attempts', 0) + 1
+    if attempts > JOB_MAX_ATTEMPTS:
+        print('Job {} failed {} times, giving up'.format(job_id, attempts - 1))
+        job_store.delete(job_id)
+        return
+    job_store.save(job_id, {**job, 'attempts': attempts})
+    completed = job_store.load_progress(job_id)
+    print('Running job {} (attempt {}), {} chunks already completed'.format(
+        job_id, attempts, len(completed)))
+
+    def save_progress(chunk, result):
+        job_store.save_progress(job_id, chunk, result)
+
+    response = execute_job(job['request'], completed, save_progress)
+    if response.status_code >= 500:
+        # keep the job, so the redelivered message only resends the report
+        raise RuntimeError('The report for job {} was not sent'.format(job_id))
+    if response.status_code != 200:
+        print('Job {} failed and will not be retried: {}'.format(
+            job_id, response.get_data(as_text=True)))
+    job_store.delete(job_id)
+
+
+def process_queued_jobs():
+    """Runs every job waiting in a local (memory or file) queue, for testing without Pub/Sub"""
+    return jobs.drain(jobs.get_job_queue(), run_job)
+
+
+def attach_results(row_count, data_size):
+    """Decides if the result table is attached rather than inlined in the email"""
+    if REPORT_DELIVERY == 'auto':
+        return row_count > REPORT_INLINE_MAX_ROWS or data_size > REPORT_INLINE_MAX_BYTES
+    return REPORT_DELIVERY == 'attachment'
+
+
+def report_table(rows, attach):
+    """Returns the result table for the email body, or a preview of it when it is attached"""
+    if not attach:
+        return list_to_html(rows)
+    return 'The full results ({} rows) are attached. First {} rows:<br><br>'.format(
+        len(rows), min(len(rows), REPORT_PREVIEW_ROWS)) + list_to_html(rows[:REPORT_PREVIEW_ROWS], get_columns(rows))
+
+
+def results_attachment(rows):
+    """Writes the result rows as a compressed file in REPORT_ATTACHMENT_FORMAT, or returns None if it cannot"""
+    from sendgrid.helpers.mail import Attachment, Disposition, FileContent, FileName, FileType
+    attachment_format = ATTACHMENT_FORMATS[REPORT_ATTACHMENT_FORMAT]
+    with span('write_attachment', rows=len(rows), format=REPORT_ATTACHMENT_FORMAT) as attachment_span:
+        try:
+            content = attachment_format['writer'](rows, get_columns(rows))
+        except Exception as e:
+            print('Could not write the {} attachment, inlining the table: {}'.format(
+                REPORT_ATTACHMENT_FORMAT, e))
+            attachment_span.set(error=str(e))
+            return None
+        attachment_span.set(bytes=len(content))
+    print('Attaching {} rows as {} bytes of {}'.format(
+        len(rows), len(content), REPORT_ATTACHMENT_FORMAT))
+    return Attachment(
+        FileContent(base64.b64encode(content).decode('ascii')),
+        FileName('looker_results.{}'.format(attachment_format['extension'])),
+        FileType(attachment_format['mimetype']),
+        Disposition('attachment'))
+
+
+@traced('execute_job')
+def execute_job(request_json, completed=None, on_chunk_complete=None):
+    """Runs the model on an execute request and emails the report. Returns 503 if sending may succeed on retry, 400 if not."""
+    request_span = current_span()
+    with timed('import palm_api (vertexai)'):
+        from palm_api import PredictionError, model_with_limit_and_backoff, predict_rows_batched, reduce
+    with timed('import sendgrid'):
+        from sendgrid import SendGridAPIClient
+        from sendgrid.helpers.mail import Mail
+
     attachment = request_json['attachment']
     action_params = request_json['data']
     form_params = request_json['form_params']
@@ -187,49 +422,123 @@ def action_execute(request):
         form_params['top_k'], int, 1, 40, 40)
     top_p = 0.8 if 'top_p' not in form_params else safe_cast(
         form_params['top_p'], float, 0.0, 1.0, 0.8)
+    row_encoding = DEFAULT_ROW_ENCODING if form_params.get(
+        'row_encoding') not in ROW_ENCODINGS else form_params['row_encoding']
+    prompt_columns = [column.strip() for column in form_params.get(
+        'prompt_columns', '').split(',') if column.strip()]
+    checkpoint_store = checkpoint = None
+    if completed is None and on_chunk_complete is None:
+        checkpoint_store = jobs.get_checkpoint_store()
+    if checkpoint_store is not None:
+        checkpoint = jobs.run_id(request_json)
+        completed = checkpoint_store.load_progress(checkpoint)
+        if completed:
+            print('Resuming run {}, {} chunks already completed'.format(
+                checkpoint, len(completed)))
+
+        def on_chunk_complete(chunk, result):
+            checkpoint_store.save_progress(checkpoint, chunk, result)
+    request_span.set(row_or_all=form_params['row_or_all'], model_type=model_type,
+                     row_encoding=row_encoding, resumed_chunks=len(completed or {}))
 
     # placeholder for model error email response
     body = 'There was a problem running the model. Please try again with less data. '
     summary = ''
-    row_chunks = 50  # mumber of rows to summarize together
+    report_file = None
+    finished = False  # every chunk succeeded, so the checkpoint can go once the report is sent
+    reduce_error = None
+    row_chunks = None  # rows are packed into chunks by the model input token budget
     try:
-        all_data = sanitize_and_load_json_str(
-            attachment['data'])
-        if form_params['row_or_all'] == 'row':
-            row_chunks = 1  # run function on each row individually
+        # rows are parsed as the model consumes them, and kept for the report table
+        all_data = []
 
-        summary = model_with_limit_and_backoff(
-            all_data, question, row_chunks, model_type, temperature, max_output_tokens, top_k, top_p)
+        def read_rows():
+            for row in timed_iter(iter_json_rows(attachment['data']), request_span, 'parse_seconds'):
+                all_data.append(row)
+                yield row
+
+        per_row = form_params['row_or_all'] in ('row', 'row_batch')
+        rows = project_rows(read_rows(), prompt_columns)
+        if per_row:
+            row_chunks = 1  # run function on each row individually
+            # identical rows are predicted once, then fanned back out below
+            rows, positions = dedupe_rows(rows)
+
+        if form_params['row_or_all'] == 'row_batch':
+            summary = predict_rows_batched(
+                rows, question, model_type, temperature, max_output_tokens, top_k, top_p, row_encoding,
+                completed=completed, on_chunk_complete=on_chunk_complete, tolerate_errors=True)
+        else:
+            summary = model_with_limit_and_backoff(
+                rows, question, row_chunks, model_type, temperature, max_output_tokens, top_k, top_p, row_encoding,
+                completed=completed, on_chunk_complete=on_chunk_complete, tolerate_errors=True)
+        errors = [result for result in summary if isinstance(result, PredictionError)]
+        if form_params['row_or_all'] == 'all' and summary and len(errors) == len(summary):
+            raise errors[0].error
 
         # if row, zip prompt_result with all_data and send html table
-        if form_params['row_or_all'] == 'row':
+        if per_row:
+            print('Predicted {} distinct rows for {} rows'.format(
+                len(summary), len(all_data)))
+            summary = [summary[i] for i in positions]
             for i in range(len(all_data)):
-                all_data[i]['prompt_result'] = summary[i]
-            body = list_to_html(all_data)
+                all_data[i]['prompt_result'] = str(summary[i])
+
+        if attach_results(len(all_data), len(attachment['data'])):
+            report_file = results_attachment(all_data)
+        attach = report_file is not None
+
+        if per_row:
+            body = ''
+            if errors:
+                body = '{} of {} rows could not be predicted, see prompt_result. Run the action again to retry only those rows.<br><br>'.format(
+                    sum(isinstance(result, PredictionError) for result in summary), len(all_data))
+            with span('render_html', rows=len(all_data)):
+                body += report_table(all_data, attach)
 
         # if all, send summary on top of all_data
         if form_params['row_or_all'] == 'all':
-            if len(summary) == 1:
+            summary = [result for result in summary if not isinstance(result, PredictionError)]
+            if not summary:
+                body = 'The query returned no results to run the model on.<br><br><br>'
+            elif len(summary) == 1:
                 body = 'Prompt Result:<br><strong>{}</strong><br><br><br>'.format(
                     summary[0].replace('\n', '<br>'))
             else:
-                reduced_summary = reduce(
-                    '\n'.join(summary), model_type, temperature, max_output_tokens, top_k, top_p)
-                body = 'Final Prompt Result:<br><strong>{}</strong><br><br>'.format(
-                    reduced_summary.replace('\n', '<br>'))
+                try:
+                    reduced_summary = reduce(
+                        summary, model_type, temperature, max_output_tokens, top_k, top_p)
+                    body = 'Final Prompt Result:<br><strong>{}</strong><br><br>'.format(
+                        reduced_summary.replace('\n', '<br>'))
+                except Exception as e:
+                    # the batch summaries are still worth sending, and are checkpointed for a re-run
+                    reduce_error = e
+                    print('Reduce failed: {}'.format(e))
+                    body = 'The batch results could not be combined into a final result: {}. Run the action again to retry.<br><br>'.format(
+                        html.escape(str(e)))
                 body += '<br><br><strong>Batch Prompt Result:</strong><br>'
                 body += '<br><br><strong>Batch Prompt Result:</strong><br>'.join(
                     summary).replace('\n', '<br>') + '<br><br><br>'
 
-            body += list_to_html(all_data)
+            if errors:
+                body += '{} of {} batches could not be summarized, so their rows are missing from the summary: {}. Run the action again to retry only those batches.<br><br><br>'.format(
+                    len(errors), len(errors) + len(summary), html.escape(str(errors[0].error)))
+
+            with span('render_html', rows=len(all_data)):
+                body += report_table(all_data, attach)
 
+        finished = not errors and reduce_error is None
     except Exception as e:
-        body += 'PaLM API Error: ' + e.message
+        body += 'PaLM API Error: ' + str(e)
+        report_file = None
         print(body)
+    request_span.set(rows=len(all_data), body_chars=len(body))
 
     if body == '':
         body = 'No response from model. Try asking a more specific question.'
 
+    print(startup_report())
+
     try:
         # todo - make email prettier
         message = Mail(
@@ -238,12 +547,21 @@ def action_execute(request):
             subject='Your GenAI Report from Looker',
             html_content=body
         )
+        if report_file is not None:
+            message.attachment = report_file
 
         sg = SendGridAPIClient(os.environ.get('SENDGRID_API_KEY'))
-        response = sg.send(message)
+        with span('sendgrid_send') as send_span:
+            response = sg.send(message)
+            send_span.set(status_code=response.status_code)
         print('Message status code: {}'.format(response.status_code))
     except Exception as e:
-        error = handle_error('SendGrid Error: ' + e.message, 400)
+        # SendGrid's HTTP errors carry the response status, anything else is a network error
+        status = getattr(e, 'status_code', None)
+        transient = status is None or status >= 500 or status == 429
+        error = handle_error('SendGrid Error: ' + str(e), 503 if transient else 400)
         return error
 
+    if checkpoint is not None and finished:
+        checkpoint_store.delete(checkpoint)
     return Response(status=200, mimetype='application/json')
@@ -0,0 +1,19 @@
+# Model metadata used by the form and execute endpoints. Kept free of heavy
+# imports so action_form can build its options without loading vertexai.
+MODEL_TYPES = {
+    'text-bison': {
+        'name': 'text-bison',
+        'version': 'text-bison@001',
+        'label': 'Text Bison',
+        'max_output_tokens': 1024,
+        'max_input_tokens': 8192
+    },
+    'code-bison': {
+        'name': 'code-bison',
+        'version': 'code-bison@001',
+        'label': 'Code Bison',
+        'max_output_tokens': 2048,
+        'max_input_tokens': 6144
+    }
+}
+DEFAULT_MODEL_TYPE = MODEL_TYPES['text-bison']['name']
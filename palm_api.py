@@ -1,48 +1,87 @@
-import backoff
-import ratelimit
 from google.api_core import exceptions
+from instrumentation import propagate, span, timed_iter
+import json
 import os
+import sys
+import threading
+import time
 import vertexai
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Callable, Iterable, Iterator
 from vertexai.preview.language_models import TextGenerationModel, CodeGenerationModel
+from model_types import MODEL_TYPES, DEFAULT_MODEL_TYPE
+from prediction_cache import cache_key, create_cache
+from rate_limiter import AdaptiveRateLimiter, create_bucket_state
+from row_encoding import ROW_ENCODINGS, DEFAULT_ROW_ENCODING, encode_frame, encode_row, encode_rows, estimate_tokens, get_columns
+from startup import timed
+from utils import iter_json_rows
 
-MODEL_TYPES = {
-    'text-bison': {
-        'name': 'text-bison',
-        'version': 'text-bison@001',
-        'label': 'Text Bison',
-        'max_output_tokens': 1024,
-        'model': TextGenerationModel.from_pretrained
-    },
-    'code-bison': {
-        'name': 'code-bison',
-        'version': 'code-bison@001',
-        'label': 'Code Bison',
-        'max_output_tokens': 2048,
-        'model': CodeGenerationModel.from_pretrained
-    }
+# Model classes are kept here rather than in model_types so the form endpoints do not import vertexai
+MODEL_LOADERS = {
+    'text-bison': TextGenerationModel.from_pretrained,
+    'code-bison': CodeGenerationModel.from_pretrained
 }
-DEFAULT_MODEL_TYPE = MODEL_TYPES['text-bison']['name']
 
 # https://cloud.google.com/vertex-ai/docs/quotas#request_quotas
-CALL_LIMIT = 50  # Number of calls to allow within a period
+# Number of calls to allow within a period, set to the project's Vertex AI quota
+CALL_LIMIT = int(os.environ.get('MODEL_CALLS_PER_MINUTE', 50))
 ONE_MINUTE = 60  # One minute in seconds
 FIVE_MINUTE = 5 * ONE_MINUTE
+MAX_WORKERS = 8  # Number of chunks to send to the model concurrently
+MAX_IN_FLIGHT = 2 * MAX_WORKERS  # Prompts built ahead of the workers before reading more rows
+CACHE_LOOKUP_BATCH = 4 * MAX_WORKERS  # Chunks looked up in the prediction cache at once
+# Maximum number of rows answered by one prompt in batched per row mode
+ROW_BATCH_SIZE = int(os.environ.get('ROW_BATCH_SIZE', 10))
+ANSWER_TOKENS = 64  # Output tokens set aside for each row's answer in a batch
+# Share of the model input token limit that prompts are planned to, as token counts are estimated
+INPUT_TOKEN_SHARE = 0.8
+MAX_SPLITS = 3  # Times a chunk rejected by the model is split in half and retried
+# Maximum number of summaries combined by one reduce call
+REDUCE_FAN_IN = int(os.environ.get('REDUCE_FAN_IN', 10))
+
+
+# Shared by every worker thread, and with RATE_LIMIT_STATE by every instance
+rate_limiter = AdaptiveRateLimiter(
+    CALL_LIMIT, ONE_MINUTE, create_bucket_state(), burst=MAX_WORKERS)
+prediction_cache = create_cache()
+
+# Model handles are created once per warm Cloud Function instance
+_models = {}
+_models_lock = threading.Lock()
+_vertexai_initialized = False
+
+
+def get_model(model_type: str) -> TextGenerationModel | CodeGenerationModel:
+    """Returns the cached model handle for model_type, initializing Vertex AI on first use."""
+    global _vertexai_initialized
+    with _models_lock:
+        if not _vertexai_initialized:
+            with timed('vertexai.init'):
+                vertexai.init(project=os.environ.get('PROJECT'),
+                              location=os.environ.get('REGION'))
+            _vertexai_initialized = True
+        if model_type not in _models:
+            with timed('load {} model'.format(model_type)):
+                _models[model_type] = MODEL_LOADERS[model_type](
+                    MODEL_TYPES[model_type]['version'])
+        return _models[model_type]
 
 
 initial_prompt_template = '''
     I am an analyst using a business intelligence tool to prompt AI to derive insights on my data.
     I will create queries to ask different questions about my first-party data.
     This may include sales data, customer data, marketing data, retention data, internal HR data, etc.
-    I will provide you the results of these queries in the form of a JSON payload.
+    I will provide you the results of these queries as {data_format}.
     Responses should be comprehensive with different metrics, insights and inferences made about the data.
     Please include insights that would be difficult to capture by the naked eye reading a chart or data table. 
-    Answer my question below in following text based on the JSON payload delimited by triple backquotes:
+    Answer my question below in following text based on the data delimited by triple backquotes:
     
     Question:
 
     ```{question}```
     
-    JSON payload: 
+    Data:
     
     ```{data}```
 
@@ -50,6 +89,25 @@ initial_prompt_template = '''
 '''
 
 
+batch_row_prompt_template = '''
+    I am an analyst using a business intelligence tool to prompt AI to derive insights on my data.
+    I will provide you rows of query results as {data_format}.
+    Each row has a "row" field with its row number.
+    Answer my question below separately for every row, based only on that row.
+    Return only a JSON array with one object per row, in the form {{"row": <row number>, "answer": "<answer>"}}.
+
+    Question:
+
+    ```{question}```
+
+    Data:
+
+    ```{data}```
+
+    JSON array:
+'''
+
+
 final_prompt_template = '''
     Write a concise summary of the following text delimited by triple backquotes.
     Return your response in bullet points which covers the key points of the text.
@@ -60,24 +118,6 @@ final_prompt_template = '''
 '''
 
 
-def backoff_hdlr(details):
-    """function to print a message when the function is retrying"""
-    print('Backing off {} seconds after {} tries'.format(
-        details['wait'], details['tries']))
-
-
-@backoff.on_exception(  # Retry with exponential backoff strategy when exceptions occur
-    backoff.expo,
-    (
-        exceptions.ResourceExhausted,
-        ratelimit.RateLimitException,
-    ),  # Exceptions to retry on
-    max_time=FIVE_MINUTE,
-    on_backoff=backoff_hdlr,  # Function to call when retrying
-)
-@ratelimit.limits(  # Limit the number of calls to the model per minute
-    calls=CALL_LIMIT, period=ONE_MINUTE
-)
 def model_prediction(model: TextGenerationModel | CodeGenerationModel,
                      model_type: str,
                      content: str,
@@ -86,67 +126,374 @@ def model_prediction(model: TextGenerationModel | CodeGenerationModel,
                      top_k: int,
                      top_p: float,
                      ):
-    """Predict using a Large Language Model."""
-    if model_type == DEFAULT_MODEL_TYPE:
-        response = model.predict(
-            content,
-            temperature=temperature,
-            max_output_tokens=max_output_tokens,
-            top_k=top_k,
-            top_p=top_p)
-    else:
-        response = model.predict(
-            content,
-            temperature=temperature,
-            max_output_tokens=max_output_tokens)
-    print('Response from {} model: {}'.format(model_type, response))
-    return response
-
-
-def model_with_limit_and_backoff(all_data: dict,
+    """Predict using a Large Language Model, retrying throttled calls at the shared rate_limiter pace."""
+    with span('model_call', model_type=model_type, prompt_chars=len(content)) as call_span:
+        deadline = time.monotonic() + FIVE_MINUTE
+        tries = 0
+        while True:
+            tries += 1
+            call_span.set(tries=tries)
+            call_span.add('rate_limit_wait_seconds', rate_limiter.acquire())
+            try:
+                if model_type == DEFAULT_MODEL_TYPE:
+                    response = model.predict(
+                        content,
+                        temperature=temperature,
+                        max_output_tokens=max_output_tokens,
+                        top_k=top_k,
+                        top_p=top_p)
+                else:
+                    response = model.predict(
+                        content,
+                        temperature=temperature,
+                        max_output_tokens=max_output_tokens)
+            except exceptions.ResourceExhausted:
+                rate = rate_limiter.on_throttle()
+                call_span.add('throttled')
+                if time.monotonic() >= deadline:
+                    raise
+                print('Quota exhausted after {} tries, retrying at {:.1f} calls per minute'.format(
+                    tries, rate))
+                continue
+            rate_limiter.on_success()
+            call_span.set(response_chars=len(response.text))
+            print('Response from {} model: {}'.format(model_type, response))
+            return response
+
+
+class PredictionError:
+    """Result of a chunk whose prediction failed, reported in place of its text"""
+
+    def __init__(self, error: Exception):
+        self.error = error
+
+    def __str__(self):
+        return 'Model error: {}'.format(self.error)
+
+
+def input_token_budget(model_type: str) -> int:
+    """Returns the estimated input tokens a prompt for model_type is planned to."""
+    return int(MODEL_TYPES[model_type]['max_input_tokens'] * INPUT_TOKEN_SHARE)
+
+
+def build_prompt(question: str,
+                 rows: list,
+                 row_encoding: str,
+                 columns: list,
+                 template: str = initial_prompt_template
+                 ) -> str:
+    """Fills a prompt template with rows serialized in row_encoding."""
+    return template.format(
+        question=question,
+        data_format=ROW_ENCODINGS[row_encoding]['description'],
+        data=encode_rows(rows, row_encoding, columns))
+
+
+def iter_chunks(rows: Iterable,
+                question: str,
+                model_type: str,
+                max_rows: int | None = None,
+                row_encoding: str = DEFAULT_ROW_ENCODING,
+                template: str = initial_prompt_template
+                ) -> Iterator[tuple[int, list]]:
+    """Greedily packs consecutive rows into as few prompts as fit input_token_budget, yielding (start, rows)"""
+    base_tokens = estimate_tokens(build_prompt(
+        question, [], row_encoding, [], template))
+    columns = []
+    known_columns = set()
+    separator = ''
+    budget = 0
+    chunk = []
+    start = 0
+    used = 0
+    for i, row in enumerate(rows):
+        if not known_columns.issuperset(row):
+            columns = columns + [column for column in row if column not in known_columns]
+            known_columns.update(row)
+            prefix, separator, suffix = encode_frame(columns, row_encoding)
+            budget = input_token_budget(model_type) - \
+                base_tokens - estimate_tokens(prefix + suffix)
+        row_tokens = estimate_tokens(
+            encode_row(row, columns, row_encoding) + separator)
+        full = max_rows is not None and len(chunk) >= max_rows
+        if chunk and (full or used + row_tokens > budget):
+            yield start, chunk
+            chunk = []
+            start = i
+            used = 0
+        chunk.append(row)
+        used += row_tokens
+    if chunk:
+        yield start, chunk
+
+
+def _batched(iterable: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def model_with_limit_and_backoff(all_data: Iterable,
                                  question: str,
-                                 row_chunks: int,
+                                 row_chunks: int | None,
                                  model_type: str,
                                  temperature: float,
                                  max_output_tokens: int,
                                  top_k: int,
-                                 top_p: float
+                                 top_p: float,
+                                 row_encoding: str = DEFAULT_ROW_ENCODING,
+                                 max_workers: int = MAX_WORKERS,
+                                 completed: dict | None = None,
+                                 on_chunk_complete=None,
+                                 template: str = initial_prompt_template,
+                                 tolerate_errors: bool = False,
+                                 combine: Callable[[list], str] = '\n'.join
                                  ):
-    """Split data into chunks to call model predict function and applies rate limiting."""
-    vertexai.init(project=os.environ.get('PROJECT'),
-                  location=os.environ.get('REGION'))
-    model = MODEL_TYPES[model_type]['model'](MODEL_TYPES[model_type]['version'])
-    initial_summary = []
-    list_size = len(all_data)
-
-    # max input token [text-bison: 8192, code-bison: 6144] so we split data into chunks
-    for i in range(0, list_size, row_chunks):
-        chunk = all_data[i:i+row_chunks]
-        print('Processing rows {} to {}.'.format(i, i+row_chunks))
-        content = initial_prompt_template.format(question=question, data=chunk)
-        summary = model_prediction(
-            model, model_type, content, temperature, max_output_tokens, top_k, top_p).text
-        initial_summary.append(summary)  # append summary to list of summaries
+    """Split data into chunks and call the model predict function on them concurrently."""
+    completed = completed or {}
+    version = MODEL_TYPES[model_type]['version']
+    predictions = {}
+    new_predictions = {}
+    futures = {}
+    chunk_count = 0
+    row_count = 0
+    resumed = 0
+    cache_hits = 0
+    errors = 0
+    in_flight = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+    failed = threading.Event()
+
+    def predict_rows(start, rows, model, content, splits=0):
+        try:
+            return model_prediction(
+                model, model_type, content, temperature, max_output_tokens, top_k, top_p).text
+        except exceptions.InvalidArgument as e:
+            if len(rows) < 2 or splits >= MAX_SPLITS:
+                raise
+            print('Rows {} to {} were rejected, retrying them in two halves: {}'.format(
+                start, start + len(rows), e))
+            half = len(rows) // 2
+            return combine([
+                predict_rows(part_start, part, model, build_prompt(
+                    question, part, row_encoding, get_columns(part), template), splits + 1)
+                for part_start, part in ((start, rows[:half]), (start + half, rows[half:]))])
+
+    def predict_chunk(i, start, rows, model, content, key):
+        end = start + len(rows)
+        try:
+            print('Processing rows {} to {}.'.format(start, end))
+            prediction = predict_rows(start, rows, model, content)
+            new_predictions[key] = prediction
+            if on_chunk_complete is not None:
+                on_chunk_complete(i, prediction)
+            return prediction
+        except Exception as e:
+            if tolerate_errors:
+                print('Rows {} to {} failed: {}'.format(start, end, e))
+                return PredictionError(e)
+            failed.set()
+            raise
+        finally:
+            in_flight.release()
+
+    # max input token [text-bison: 8192, code-bison: 6144] so we pack data into chunks that fit
+    with span('dispatch', model_type=model_type) as dispatch_span, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor:
+        chunks = timed_iter(iter_chunks(all_data, question, model_type, row_chunks, row_encoding, template),
+                            dispatch_span, 'chunking_seconds')
+        # model calls run in worker threads but are traced under this span
+        predict_in_span = propagate(predict_chunk)
+        for batch in _batched(enumerate(chunks), CACHE_LOOKUP_BATCH):
+            if failed.is_set():
+                break  # stop reading rows, the error is raised below
+            pending = []
+            for i, (start, rows) in batch:
+                chunk_count += 1
+                row_count += len(rows)
+                if i in completed:
+                    predictions[i] = completed[i]
+                    resumed += 1
+                    continue
+                content = build_prompt(
+                    question, rows, row_encoding, get_columns(rows), template)
+                key = cache_key(version, content, temperature,
+                                max_output_tokens, top_k, top_p)
+                pending.append((i, start, rows, content, key))
+
+            cached = prediction_cache.get_many([key for *_, key in pending])
+            for i, start, rows, content, key in pending:
+                if key in cached:
+                    predictions[i] = cached[key]
+                    cache_hits += 1
+                    continue
+                in_flight.acquire()  # wait for a worker before holding another prompt
+                futures[i] = executor.submit(
+                    predict_in_span, i, start, rows, get_model(model_type), content, key)
+
+        # result() re-raises the first model error, as the sequential loop did
+        for i, future in futures.items():
+            predictions[i] = future.result()
+            errors += isinstance(predictions[i], PredictionError)
+        dispatch_span.set(rows=row_count, chunks=chunk_count,
+                          resumed=resumed, cache_hits=cache_hits, errors=errors)
+
+    print('Split {} rows into {} chunks: {} already completed, {} found in the prediction cache, {} failed.'.format(
+        row_count, chunk_count, resumed, cache_hits, errors))
+    prediction_cache.set_many(new_predictions)
+
+    return [predictions[i] for i in range(chunk_count)]
+
 
-    return initial_summary
+def parse_batch_response(text: str, rows: range) -> dict:
+    """Parses a batch reply into a dict of row numbers and answers, keeping only row numbers in `rows`"""
+    start = text.find('[')
+    if start == -1:
+        return {}
+    end = text.rfind(']') + 1 or len(text)  # drop any text after the array
+    answers = {}
+    try:
+        for item in iter_json_rows(text[start:end]):
+            if (isinstance(item, dict) and isinstance(item.get('row'), int) and
+                    item['row'] in rows and item.get('answer') is not None):
+                answers.setdefault(item['row'], str(item['answer']))
+    except json.JSONDecodeError:
+        pass
+    return answers
 
 
-def reduce(initial_summary: any,
+def join_batch_replies(replies: list) -> str:
+    """Joins the batch replies for the halves of a split batch into one JSON array."""
+    answers = {}
+    for reply in replies:
+        for row, answer in parse_batch_response(reply, range(sys.maxsize)).items():
+            answers.setdefault(row, answer)
+    return json.dumps([{'row': row, 'answer': answer} for row, answer in answers.items()])
+
+
+def predict_rows_batched(rows: Iterable,
+                         question: str,
+                         model_type: str,
+                         temperature: float,
+                         max_output_tokens: int,
+                         top_k: int,
+                         top_p: float,
+                         row_encoding: str = DEFAULT_ROW_ENCODING,
+                         completed: dict | None = None,
+                         on_chunk_complete=None,
+                         tolerate_errors: bool = False
+                         ) -> list:
+    """Answers the question for every row, packing several rows into each prompt."""
+    distinct = list(rows)
+    # Looker field names are always view.field, so "row" cannot clash with one
+    numbered = [{'row': i, **row} for i, row in enumerate(distinct)]
+    batch_size = max(1, min(ROW_BATCH_SIZE, max_output_tokens // ANSWER_TOKENS))
+    replies = model_with_limit_and_backoff(
+        numbered, question, batch_size, model_type, temperature, max_output_tokens, top_k, top_p,
+        row_encoding, completed=completed, on_chunk_complete=on_chunk_complete,
+        template=batch_row_prompt_template, tolerate_errors=tolerate_errors, combine=join_batch_replies)
+
+    # chunking is deterministic, so replan to learn which rows each reply covers
+    answers = {}
+    chunks = iter_chunks(numbered, question, model_type,
+                         batch_size, row_encoding, batch_row_prompt_template)
+    for reply, (start, chunk) in zip(replies, chunks):
+        if isinstance(reply, PredictionError):
+            continue
+        answers.update(parse_batch_response(
+            reply, range(start, start + len(chunk))))
+
+    missing = [i for i in range(len(numbered)) if i not in answers]
+    print('Batched {} rows into {} prompts, {} rows need a single row prompt.'.format(
+        len(numbered), len(replies), len(missing)))
+    if missing:
+        completed = completed or {}
+        # single row prompts are checkpointed as chunk -1 - row, apart from the batches
+        missing_completed = {i: completed[-1 - row] for i, row in enumerate(missing)
+                             if -1 - row in completed}
+
+        def on_row_complete(i, result):
+            if on_chunk_complete is not None:
+                on_chunk_complete(-1 - missing[i], result)
+
+        retried = model_with_limit_and_backoff(
+            [distinct[i] for i in missing], question, 1, model_type,
+            temperature, max_output_tokens, top_k, top_p, row_encoding,
+            completed=missing_completed, on_chunk_complete=on_row_complete, tolerate_errors=tolerate_errors)
+        answers.update(zip(missing, retried))
+
+    return [answers[i] for i in range(len(numbered))]
+
+
+def plan_reduce_batches(summaries: list,
+                        model_type: str,
+                        fan_in: int
+                        ) -> list[tuple[int, int]]:
+    """Groups consecutive summaries into batches of two to `fan_in` that fit the model input token budget"""
+    budget = input_token_budget(model_type) - estimate_tokens(
+        final_prompt_template.format(text=''))
+    batches = []
+    start = 0
+    used = 0
+    for i, summary in enumerate(summaries):
+        summary_tokens = estimate_tokens(summary + '\n')
+        full = i - start >= fan_in
+        if i - start >= 2 and (full or used + summary_tokens > budget):
+            batches.append((start, i))
+            start = i
+            used = 0
+        used += summary_tokens
+    if start < len(summaries):
+        batches.append((start, len(summaries)))
+    return batches
+
+
+def reduce(initial_summary: list,
            model_type: str,
            temperature: float,
            max_output_tokens: int,
            top_k: int,
-           top_p: float
+           top_p: float,
+           fan_in: int = REDUCE_FAN_IN,
+           max_workers: int = MAX_WORKERS
            ):
     """creates a summary of the summaries"""
+    summaries = list(initial_summary)
+    if len(summaries) <= 1:
+        return summaries[0] if summaries else ''
+    model = get_model(model_type)
+    version = MODEL_TYPES[model_type]['version']
+    level = 0
+    cache_hits = 0
 
-    vertexai.init(project=os.environ.get('PROJECT'),
-                  location=os.environ.get('REGION'))
-    model = MODEL_TYPES[model_type]['model'](MODEL_TYPES[model_type]['version'])
-    content = final_prompt_template.format(text=initial_summary)
-
-    # Generate a summary using the model and the prompt
-    summary = model_prediction(
-        model, model_type, content, temperature, max_output_tokens, top_k, top_p).text
+    def reduce_batch(bounds, content, key):
+        if content is None:
+            return summaries[bounds[0]]
+        if key in cached:
+            return cached[key]
+        # Generate a summary using the model and the prompt
+        prediction = model_prediction(
+            model, model_type, content, temperature, max_output_tokens, top_k, top_p).text
+        new_predictions[key] = prediction
+        return prediction
 
-    return summary
+    with span('reduce', model_type=model_type, summaries=len(summaries)) as reduce_span:
+        while True:
+            level += 1
+            batches = plan_reduce_batches(summaries, model_type, max(fan_in, 2))
+            print('Reduce level {}: {} summaries into {} batches.'.format(
+                level, len(summaries), len(batches)))
+            # a batch of one summary is carried to the next level without a prompt
+            contents = [final_prompt_template.format(text='\n'.join(summaries[start:end]))
+                        if end - start > 1 else None for start, end in batches]
+            keys = [content and cache_key(version, content, temperature, max_output_tokens, top_k, top_p)
+                    for content in contents]
+            cached = prediction_cache.get_many([key for key in keys if key])
+            cache_hits += len(cached)
+            new_predictions = {}
+            with span('reduce_level', level=level, summaries=len(summaries), batches=len(batches)), \
+                    ThreadPoolExecutor(max_workers=min(max_workers, len(batches))) as executor:
+                summaries = list(executor.map(propagate(reduce_batch), batches, contents, keys))
+            prediction_cache.set_many(new_predictions)
+            if len(summaries) == 1:
+                reduce_span.set(levels=level, cache_hits=cache_hits)
+                return summaries[0]
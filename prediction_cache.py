@@ -0,0 +1,209 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_TTL = 24 * 60 * 60  # One day in seconds, covers daily scheduled deliveries
+DEFAULT_MAX_ENTRIES = 10000  # Entries kept by the in-process cache before evicting
+
+
+def cache_key(model_version: str,
+              content: str,
+              temperature: float,
+              max_output_tokens: int,
+              top_k: int,
+              top_p: float
+              ) -> str:
+    """Returns a content address for a prediction from its prompt and model parameters"""
+    payload = json.dumps([model_version, content, temperature,
+                         max_output_tokens, top_k, top_p])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class PredictionCache:
+    """Interface for prediction cache backends. Lookups and writes are batched."""
+
+    def get_many(self, keys: list) -> dict:
+        """Returns a dict of the keys found in the cache and their values"""
+        raise NotImplementedError
+
+    def set_many(self, items: dict):
+        """Stores a dict of keys and values"""
+        raise NotImplementedError
+
+
+class NullCache(PredictionCache):
+    """Cache that never stores anything"""
+
+    def get_many(self, keys):
+        return {}
+
+    def set_many(self, items):
+        pass
+
+
+class MemoryCache(PredictionCache):
+    """In-process LRU cache with a TTL, shared by requests on a warm instance"""
+
+    def __init__(self, ttl: float = DEFAULT_TTL, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        found = {}
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    continue
+                expires, value = entry
+                if expires < now:
+                    del self._entries[key]
+                    continue
+                self._entries.move_to_end(key)
+                found[key] = value
+        return found
+
+    def set_many(self, items):
+        expires = time.time() + self.ttl
+        with self._lock:
+            for key, value in items.items():
+                self._entries[key] = (expires, value)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class SQLiteCache(PredictionCache):
+    """Disk cache in a local SQLite file. Least recently used entries beyond max_entries are evicted."""
+
+    def __init__(self, path: str, ttl: float = DEFAULT_TTL, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS predictions '
+                         '(key TEXT PRIMARY KEY, value TEXT, expires REAL, used REAL)')
+        self._db.commit()
+
+    def get_many(self, keys):
+        found = {}
+        now = time.time()
+        with self._lock:
+            # stay well under SQLite's bound parameter limit
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i+500]
+                placeholders = ','.join('?' * len(batch))
+                rows = self._db.execute(
+                    'SELECT key, value FROM predictions WHERE expires >= ? AND key IN ({})'.format(
+                        placeholders), [now, *batch]).fetchall()
+                found.update(rows)
+            if found:
+                self._db.executemany('UPDATE predictions SET used = ? WHERE key = ?',
+                                     [(now, key) for key in found])
+                self._db.commit()
+        return found
+
+    def set_many(self, items):
+        now = time.time()
+        with self._lock:
+            self._db.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)',
+                                 [(key, value, now + self.ttl, now) for key, value in items.items()])
+            self._db.execute('DELETE FROM predictions WHERE expires < ?', [now])
+            self._db.execute('DELETE FROM predictions WHERE key NOT IN '
+                             '(SELECT key FROM predictions ORDER BY used DESC LIMIT ?)', [self.max_entries])
+            self._db.commit()
+
+
+class RedisCache(PredictionCache):
+    """Cache in Redis, or any client implementing mget(keys) and a pipeline() with set(key, value, ex=seconds).
+
+    Redis applies the TTL and its own maxmemory eviction policy.
+    """
+
+    def __init__(self, client, ttl: float = DEFAULT_TTL, prefix: str = 'vertex-ai-actions:prediction:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get_many(self, keys):
+        if not keys:
+            return {}
+        values = self.client.mget([self.prefix + key for key in keys])
+        return {key: value.decode('utf-8') if isinstance(value, bytes) else value
+                for key, value in zip(keys, values) if value is not None}
+
+    def set_many(self, items):
+        if not items:
+            return
+        # one round trip for the whole batch
+        pipeline = self.client.pipeline(transaction=False)
+        for key, value in items.items():
+            pipeline.set(self.prefix + key, value, ex=int(self.ttl))
+        pipeline.execute()
+
+
+class LocalRedis:
+    """Dict backed stand-in for the subset of the Redis client used here, for local runs"""
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def mget(self, keys):
+        now = time.time()
+        with self._lock:
+            return [value if expires is None or expires >= now else None
+                    for value, expires in (self._values.get(key, (None, None)) for key in keys)]
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            self._values[key] = (value, time.time() + ex if ex else None)
+        return True
+
+    def pipeline(self, transaction=True):
+        return LocalRedisPipeline(self)
+
+
+class LocalRedisPipeline:
+    """Queues set calls on a LocalRedis until execute(), like a Redis pipeline"""
+
+    def __init__(self, client: LocalRedis):
+        self.client = client
+        self._commands = []
+
+    def set(self, key, value, ex=None):
+        self._commands.append((key, value, ex))
+        return self
+
+    def execute(self):
+        commands, self._commands = self._commands, []
+        return [self.client.set(*command) for command in commands]
+
+
+def create_cache(backend: str | None = None) -> PredictionCache:
+    """Creates the prediction cache selected by PREDICTION_CACHE (memory, sqlite, redis or none)"""
+    backend = backend or os.environ.get('PREDICTION_CACHE', 'memory')
+    ttl = float(os.environ.get('PREDICTION_CACHE_TTL', DEFAULT_TTL))
+    max_entries = int(os.environ.get(
+        'PREDICTION_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES))
+
+    if backend == 'memory':
+        return MemoryCache(ttl, max_entries)
+    if backend == 'sqlite':
+        return SQLiteCache(os.environ.get('PREDICTION_CACHE_PATH', '/tmp/prediction_cache.sqlite3'),
+                           ttl, max_entries)
+    if backend == 'redis':
+        import redis  # optional dependency, only needed for the redis backend
+        return RedisCache(redis.Redis.from_url(os.environ.get('REDIS_URL', 'redis://localhost:6379/0')), ttl)
+    if backend == 'local-redis':
+        return RedisCache(LocalRedis(), ttl)
+    if backend == 'none':
+        return NullCache()
+    raise ValueError('Unknown prediction cache backend: {}'.format(backend))
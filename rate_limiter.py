@@ -0,0 +1,148 @@
+import json
+import os
+import threading
+import time
+
+# Token bucket limiter for model calls. The bucket lives in a BucketState so
+# that, with a shared backend, every Cloud Function instance draws from the
+# same quota. All times are wall clock seconds so they compare across processes.
+
+
+class BucketState:
+    """Interface for storing the bucket. transact must apply fn atomically."""
+
+    def transact(self, fn):
+        """Calls fn(state) -> (new_state, result) atomically and returns result"""
+        raise NotImplementedError
+
+
+class LocalBucketState(BucketState):
+    """Bucket shared by the threads of one process"""
+
+    def __init__(self):
+        self._state = {}
+        self._lock = threading.Lock()
+
+    def transact(self, fn):
+        with self._lock:
+            self._state, result = fn(dict(self._state))
+            return result
+
+
+class FileBucketState(BucketState):
+    """Bucket in a locked JSON file, shared by processes on one machine. Local stand-in for redis."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()  # flock does not exclude threads sharing a process
+
+    def transact(self, fn):
+        import fcntl
+        with self._lock, open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                raw = f.read()
+                state, result = fn(json.loads(raw) if raw else {})
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return result
+
+
+class RedisBucketState(BucketState):
+    """Bucket in a redis key, shared by every instance. Uses WATCH/MULTI so concurrent updates retry."""
+
+    def __init__(self, client, key: str = 'vertex-ai-actions:rate-limit', ttl: int = 24 * 60 * 60):
+        self.client = client
+        self.key = key
+        self.ttl = ttl
+
+    def transact(self, fn):
+        result = None
+
+        def update(pipe):
+            nonlocal result
+            raw = pipe.get(self.key)
+            state, result = fn(json.loads(raw) if raw else {})
+            pipe.multi()
+            pipe.set(self.key, json.dumps(state), ex=self.ttl)
+
+        self.client.transaction(update, self.key)
+        return result
+
+
+class AdaptiveRateLimiter:
+    """Token bucket that paces calls to a rate and adapts the rate to throttling (AIMD)"""
+
+    def __init__(self,
+                 max_rate: float,
+                 period: float,
+                 state: BucketState | None = None,
+                 burst: int = 1,
+                 min_rate: float = 1,
+                 decrease: float = 0.5,
+                 increase: float = 1,
+                 cooldown: float = 10
+                 ):
+        self.max_rate = max_rate
+        self.period = period
+        self.state = state or LocalBucketState()
+        self.burst = burst
+        self.min_rate = min_rate
+        self.decrease = decrease
+        self.increase = increase
+        self.cooldown = cooldown
+
+    def _reserve(self, state):
+        now = time.time()
+        rate = state.get('rate', self.max_rate)
+        per_second = rate / self.period
+        tokens = min(self.burst, state.get('tokens', self.burst) +
+                     (now - state.get('updated', now)) * per_second) - 1
+        state.update(rate=rate, tokens=tokens, updated=now)
+        # a negative balance is a reservation further along the schedule
+        return state, max(0.0, -tokens / per_second)
+
+    def acquire(self) -> float:
+        """Blocks until the next free slot and returns the seconds waited"""
+        wait = self.state.transact(self._reserve)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def on_success(self):
+        def update(state):
+            rate = state.get('rate', self.max_rate)
+            state['rate'] = min(self.max_rate, rate + self.increase / rate)
+            return state, state['rate']
+        return self.state.transact(update)
+
+    def on_throttle(self):
+        def update(state):
+            now = time.time()
+            rate = state.get('rate', self.max_rate)
+            if now - state.get('decreased', 0) >= self.cooldown:
+                rate = max(self.min_rate, rate * self.decrease)
+                state.update(rate=rate, decreased=now)
+            return state, rate
+        return self.state.transact(update)
+
+    def current_rate(self) -> float:
+        return self.state.transact(lambda state: (state, state.get('rate', self.max_rate)))
+
+
+def create_bucket_state(backend: str | None = None) -> BucketState:
+    """Creates the bucket state selected by RATE_LIMIT_STATE (local, file or redis)"""
+    backend = backend or os.environ.get('RATE_LIMIT_STATE', 'local')
+    if backend == 'local':
+        return LocalBucketState()
+    if backend == 'file':
+        return FileBucketState(os.environ.get('RATE_LIMIT_FILE', '/tmp/vertex-ai-rate-limit.json'))
+    if backend == 'redis':
+        import redis  # optional dependency, only needed for the redis backend
+        return RedisBucketState(redis.Redis.from_url(os.environ.get('REDIS_URL', 'redis://localhost:6379/0')))
+    raise ValueError('Unknown rate limit state: {}'.format(backend))
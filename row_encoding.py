@@ -0,0 +1,88 @@
+import csv
+import io
+import json
+
+CHARS_PER_TOKEN = 3  # Conservative estimate for text other than digits
+DIGITS = '0123456789'  # PaLM tokenizers split numbers into one token per digit
+
+# Encodings used to serialize Looker rows into prompts. `description` is
+# substituted into the prompt so the model knows how to read the data.
+ROW_ENCODINGS = {
+    'json': {
+        'name': 'json',
+        'label': 'JSON (one object per row)',
+        'description': 'a JSON array with one object per row'
+    },
+    'columnar': {
+        'name': 'columnar',
+        'label': 'Columnar JSON',
+        'description': 'a JSON object with a "columns" list of field names and a "rows" list of value lists in the same order'
+    },
+    'csv': {
+        'name': 'csv',
+        'label': 'CSV',
+        'description': 'CSV with a header row of field names'
+    },
+    'tsv': {
+        'name': 'tsv',
+        'label': 'TSV',
+        'description': 'tab separated values with a header row of field names'
+    }
+}
+DEFAULT_ROW_ENCODING = ROW_ENCODINGS['columnar']['name']
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimates the number of input tokens text will use from its length and digits."""
+    digits = sum(map(text.count, DIGITS))
+    return digits - (-(len(text) - digits) // CHARS_PER_TOKEN)
+
+
+def get_columns(rows: list) -> list:
+    """Returns the field names of rows in order of first appearance"""
+    columns = {}
+    for row in rows:
+        columns.update(dict.fromkeys(row))
+    return list(columns)
+
+
+def _delimited(values: list, delimiter: str) -> str:
+    buffer = io.StringIO()
+    csv.writer(buffer, delimiter=delimiter, lineterminator='\n').writerow(
+        ['' if value is None else value for value in values])
+    return buffer.getvalue()
+
+
+def encode_frame(columns: list, encoding: str) -> tuple[str, str, str]:
+    """Returns the (prefix, separator, suffix) wrapped around encoded rows"""
+    if encoding == 'json':
+        return '[', ',', ']'
+    if encoding == 'columnar':
+        return '{"columns":' + json.dumps(columns, separators=(',', ':')) + ',"rows":[', ',', ']}'
+    if encoding == 'csv':
+        return _delimited(columns, ','), '', ''
+    if encoding == 'tsv':
+        return _delimited(columns, '\t'), '', ''
+    raise ValueError('Unknown row encoding: {}'.format(encoding))
+
+
+def encode_row(row: dict, columns: list, encoding: str) -> str:
+    """Serializes a single row, without the frame shared by all rows"""
+    if encoding == 'json':
+        return json.dumps(row, separators=(',', ':'), default=str)
+    values = [row.get(column) for column in columns]
+    if encoding == 'columnar':
+        return json.dumps(values, separators=(',', ':'), default=str)
+    if encoding == 'csv':
+        return _delimited(values, ',')
+    if encoding == 'tsv':
+        return _delimited(values, '\t')
+    raise ValueError('Unknown row encoding: {}'.format(encoding))
+
+
+def encode_rows(rows: list, encoding: str = DEFAULT_ROW_ENCODING, columns: list | None = None) -> str:
+    """Serializes rows for a prompt, writing field names once where the encoding allows"""
+    if columns is None:
+        columns = get_columns(rows)
+    prefix, separator, suffix = encode_frame(columns, encoding)
+    return prefix + separator.join(encode_row(row, columns, encoding) for row in rows) + suffix
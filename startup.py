@@ -0,0 +1,28 @@
+import time
+from contextlib import contextmanager
+
+# Seconds spent in each timed startup step on this instance, in the order they ran
+STARTUP_TIMINGS = {}
+
+
+@contextmanager
+def timed(step: str):
+    """Records and prints how long a startup step takes, the first time it runs"""
+    if step in STARTUP_TIMINGS:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STARTUP_TIMINGS[step] = elapsed
+        print('Startup: {} took {:.3f}s'.format(step, elapsed))
+
+
+def startup_report() -> str:
+    """Summarizes the startup timings recorded so far"""
+    total = sum(STARTUP_TIMINGS.values())
+    steps = ', '.join('{}: {:.3f}s'.format(step, elapsed)
+                      for step, elapsed in STARTUP_TIMINGS.items())
+    return 'Startup total {:.3f}s ({})'.format(total, steps)
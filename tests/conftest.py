@@ -0,0 +1,7 @@
+import os
+
+# read when the modules under test are imported, so nothing reaches /tmp or the logs
+os.environ.setdefault('PREDICTION_CACHE', 'none')
+os.environ.setdefault('CHECKPOINT_STORE', 'memory')
+os.environ.setdefault('TRACE_EXPORTER', 'memory')
+os.environ.setdefault('LOOKER_AUTH_TOKEN', 'test')
@@ -0,0 +1,35 @@
+import os
+import time
+from jobs import FileJobStore
+
+
+def test_file_store_keeps_progress(tmp_path):
+    store = FileJobStore(str(tmp_path))
+    store.save('job', {'request': {'a': 1}})
+    store.save_progress('job', 0, 'first')
+    store.save_progress('job', -3, 'single row')
+    assert store.load('job') == {'request': {'a': 1}}
+    assert store.load_progress('job') == {0: 'first', -3: 'single row'}
+    store.delete('job')
+    assert store.load('job') is None
+    assert store.load_progress('job') == {}
+
+
+def test_file_store_sweeps_expired_checkpoints(tmp_path):
+    store = FileJobStore(str(tmp_path), ttl=60)
+    store.save_progress('old', 0, 'stale')
+    store.save_progress('new', 0, 'fresh')
+    an_hour_ago = time.time() - 3600
+    os.utime(os.path.join(str(tmp_path), 'old.progress.jsonl'), (an_hour_ago, an_hour_ago))
+
+    assert store.load_progress('new') == {0: 'fresh'}  # the first load sweeps
+    assert store.load_progress('old') == {}
+    assert sorted(os.listdir(str(tmp_path))) == ['new.progress.jsonl']
+
+
+def test_file_store_without_ttl_keeps_everything(tmp_path):
+    store = FileJobStore(str(tmp_path))
+    store.save_progress('old', 0, 'stale')
+    an_hour_ago = time.time() - 3600
+    os.utime(os.path.join(str(tmp_path), 'old.progress.jsonl'), (an_hour_ago, an_hour_ago))
+    assert store.load_progress('old') == {0: 'stale'}
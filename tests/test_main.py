@@ -0,0 +1,337 @@
+import base64
+import copy
+import csv
+import gzip
+import importlib
+import importlib.util
+import io
+import json
+import pytest
+import jobs
+import main
+import palm_api
+from benchmarks import fakes
+from python_http_client.exceptions import HTTPError
+from rate_limiter import AdaptiveRateLimiter
+
+
+class RecordingSendGridClient(fakes.FakeSendGridClient):
+    """Keeps every message sent, or raises `error` instead of sending"""
+
+    def __init__(self, usage, error=None):
+        super().__init__(usage)
+        self.error = error
+        self.messages = []
+
+    def send(self, message):
+        if self.error is not None:
+            raise self.error
+        self.messages.append(message.get())
+        return super().send(message)
+
+
+@pytest.fixture
+def usage():
+    return fakes.Usage()
+
+
+@pytest.fixture
+def sendgrid(usage, monkeypatch):
+    client = RecordingSendGridClient(usage)
+    monkeypatch.setattr(palm_api, 'rate_limiter', AdaptiveRateLimiter(60000, 60, burst=100))
+    monkeypatch.setattr(jobs, '_checkpoint_store', jobs.MemoryJobStore())
+    with fakes.installed(fakes.FakeModel(usage), client):
+        yield client
+
+
+def execute_request(rows, mode='all'):
+    return {
+        'attachment': {'mimetype': 'application/json', 'extension': 'json', 'data': json.dumps(rows)},
+        'data': {'email': 'analyst@example.com', 'user_id': '1'},
+        'form_params': {'question': 'What stands out?', 'row_or_all': mode, 'default_params': 'yes'},
+    }
+
+
+def email_body(message):
+    return message['content'][0]['value']
+
+
+def test_all_results_without_rows(sendgrid, usage):
+    response = main.execute_job(execute_request([]))
+    assert response.status_code == 200
+    body = email_body(sendgrid.messages[0])
+    assert 'no results' in body
+    assert 'Error' not in body
+    assert usage.model_calls == 0
+
+
+def test_all_results(sendgrid, usage):
+    rows = [{'users.name': 'user {}'.format(i), 'orders.count': i} for i in range(30)]
+    response = main.execute_job(execute_request(rows))
+    assert response.status_code == 200
+    body = email_body(sendgrid.messages[0])
+    assert body.startswith('Prompt Result:<br><strong>insight')
+    assert '<td>user 29</td>' in body
+    assert usage.model_calls == 1
+
+
+def test_reduce_failure_still_sends_batch_results(sendgrid, usage, monkeypatch):
+    rows = [{'users.name': 'user {}'.format(i), 'users.note': 'x' * 1000} for i in range(40)]
+    request = execute_request(rows)
+
+    reduce = palm_api.reduce
+
+    def failing_reduce(*args):
+        raise RuntimeError('reduce quota')
+    monkeypatch.setattr(palm_api, 'reduce', failing_reduce)
+    assert main.execute_job(request).status_code == 200
+    body = email_body(sendgrid.messages[0])
+    assert 'could not be combined into a final result: reduce quota' in body
+    assert body.count('Batch Prompt Result') == usage.model_calls > 1
+    assert 'PaLM API Error' not in body
+    assert '<td>user 39</td>' in body
+    # the batches stay checkpointed, so a re-run only repeats the reduce
+    assert len(jobs.get_checkpoint_store().load_progress(jobs.run_id(request))) == usage.model_calls
+
+    monkeypatch.setattr(palm_api, 'reduce', reduce)
+    batches = usage.model_calls
+    assert main.execute_job(request).status_code == 200
+    assert email_body(sendgrid.messages[1]).startswith('Final Prompt Result:')
+    assert usage.model_calls == batches + 1
+    assert jobs.get_checkpoint_store().load_progress(jobs.run_id(request)) == {}
+
+
+class FormRequest:
+    """Looker form request with the auth token and optional extra headers"""
+
+    def __init__(self, form_params, headers=None):
+        self.method = 'POST'
+        self.headers = {'authorization': 'Token token="test"', **(headers or {})}
+        self.form_params = form_params
+
+    def get_json(self):
+        return {'form_params': self.form_params}
+
+
+FORM_PARAMS = [
+    {},
+    {'default_params': 'yes'},
+    {'default_params': 'yes', 'model_type': 'code-bison'},
+    {'default_params': 'no'},
+    {'default_params': 'no', 'model_type': ''},
+    {'default_params': 'no', 'model_type': 'text-bison'},
+    {'default_params': 'no', 'model_type': 'code-bison'},
+    {'default_params': 'no', 'model_type': 'text-bison', 'question': 'Why "churn"?',
+     'row_or_all': 'row_batch', 'prompt_columns': 'users.state'},
+]
+
+
+def expected_form(form_params):
+    custom_params = form_params.get('default_params') == 'no'
+    fields = main.build_form(custom_params, custom_params and 'model_type' in form_params,
+                             custom_params and form_params.get('model_type') == 'text-bison')
+    for field in fields:
+        if field['name'] in main.FORM_DEFAULTS:
+            field['default'] = form_params.get(field['name'], main.FORM_DEFAULTS[field['name']])
+    return json.dumps(fields)
+
+
+@pytest.mark.parametrize('form_params', FORM_PARAMS)
+def test_action_form(form_params):
+    response = main.action_form(FormRequest(form_params))
+    assert response.status_code == 200
+    assert response.get_data(as_text=True) == expected_form(form_params)
+
+
+def test_action_form_does_not_change_cached_variants():
+    for form_params in FORM_PARAMS:
+        main.action_form(FormRequest(form_params))  # builds every variant
+    variants = copy.deepcopy(main._form_variants)
+    for form_params in FORM_PARAMS:
+        main.action_form(FormRequest(form_params))
+    assert main._form_variants == variants
+    # a later request without the params gets the stock defaults back
+    assert main.action_form(FormRequest({})).get_data(as_text=True) == expected_form({})
+
+
+def test_action_form_not_modified():
+    form_params = {'default_params': 'no', 'model_type': 'text-bison', 'question': 'Why?'}
+    body_etag = main.action_form(FormRequest(form_params)).headers['ETag']
+    response = main.action_form(FormRequest(form_params, {'If-None-Match': 'W/' + body_etag}))
+    assert response.status_code == 304
+    assert response.get_data() == b''
+    # a different default is a different body
+    changed = main.action_form(FormRequest(dict(form_params, question='Why not?'), {'If-None-Match': body_etag}))
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != body_etag
+
+
+def test_action_form_requires_the_token():
+    request = FormRequest({}, {'authorization': 'Token token="wrong"'})
+    assert main.action_form(request).status_code == 403
+
+
+@pytest.mark.parametrize('mode, model_calls', [('row', 2), ('row_batch', 1)])
+def test_duplicate_rows_are_predicted_once(sendgrid, usage, monkeypatch, mode, model_calls):
+    model_prediction = palm_api.model_prediction
+
+    def prediction_by_state(model, model_type, content, *params):
+        response = model_prediction(model, model_type, content, *params)
+        if 'JSON array:' in content:
+            return response
+        return fakes.FakeResponse('state CA' if '"CA"' in content else 'state NY')
+
+    monkeypatch.setattr(palm_api, 'model_prediction', prediction_by_state)
+    monkeypatch.setattr(main, 'REPORT_DELIVERY', 'attachment')
+    states = ['CA', 'NY', 'CA', 'CA', 'NY', 'CA']
+    rows = [{'users.name': 'user {}'.format(i), 'users.state': state} for i, state in enumerate(states)]
+    request = execute_request(rows, mode)
+    request['form_params']['prompt_columns'] = 'users.state'
+    assert main.execute_job(request).status_code == 200
+    assert usage.model_calls == model_calls
+
+    content = gzip.decompress(base64.b64decode(attachments(sendgrid.messages[0])[0]['content'])).decode('utf-8')
+    report = list(csv.DictReader(io.StringIO(content)))
+    assert [row['users.name'] for row in report] == [row['users.name'] for row in rows]
+    if mode == 'row':
+        assert [row['prompt_result'] for row in report] == ['state ' + state for state in states]
+    else:
+        # distinct rows are numbered in order of first appearance
+        assert [row['prompt_result'] for row in report] == [
+            'answer 0' if state == 'CA' else 'answer 1' for state in states]
+
+
+def attachments(message):
+    return message.get('attachments', [])
+
+
+@pytest.mark.parametrize('mode', ['all', 'row'])
+def test_large_results_are_attached(sendgrid, monkeypatch, mode):
+    monkeypatch.setattr(main, 'REPORT_DELIVERY', 'attachment')
+    rows = [{'users.name': 'user {}'.format(i)} for i in range(30)]
+    main.execute_job(execute_request(rows, mode))
+    message = sendgrid.messages[0]
+    assert 'The full results (30 rows) are attached' in email_body(message)
+    assert [attachment['filename'] for attachment in attachments(message)] == ['looker_results.csv.gz']
+    content = gzip.decompress(base64.b64decode(attachments(message)[0]['content'])).decode('utf-8')
+    assert content.splitlines()[0] == ('users.name' if mode == 'all' else 'users.name,prompt_result')
+
+
+def test_attachment_failure_inlines_the_table(sendgrid, monkeypatch):
+    def missing_pyarrow(rows, columns):
+        raise ModuleNotFoundError("No module named 'pyarrow'")
+
+    monkeypatch.setattr(main, 'REPORT_DELIVERY', 'attachment')
+    monkeypatch.setitem(main.ATTACHMENT_FORMATS, 'csv', dict(main.ATTACHMENT_FORMATS['csv'], writer=missing_pyarrow))
+    rows = [{'users.name': 'user {}'.format(i)} for i in range(30)]
+    response = main.execute_job(execute_request(rows))
+    assert response.status_code == 200
+    message = sendgrid.messages[0]
+    body = email_body(message)
+    assert 'attached' not in body
+    assert 'Error' not in body
+    assert '<td>user 29</td>' in body
+    assert attachments(message) == []
+
+
+@pytest.mark.parametrize('variable, value, problem', [
+    ('REPORT_DELIVERY', 'carrier-pigeon', 'Unknown report delivery: carrier-pigeon'),
+    ('REPORT_ATTACHMENT_FORMAT', 'xlsx', 'Unknown report attachment format: xlsx'),
+])
+def test_bad_report_settings_fall_back_to_inline(monkeypatch, capsys, variable, value, problem):
+    monkeypatch.setenv(variable, value)
+    try:
+        importlib.reload(main)
+        assert 'Warning: {}. Result tables will be sent inline.'.format(problem) in capsys.readouterr().out
+        assert main.REPORT_DELIVERY == 'inline'
+        assert main.action_form(FormRequest({})).status_code == 200
+    finally:
+        monkeypatch.undo()
+        importlib.reload(main)
+
+
+def test_report_settings_problem():
+    assert main.report_settings_problem('auto', 'csv') is None
+    assert main.report_settings_problem('attachment', 'csv') is None
+    assert main.report_settings_problem('email', 'csv') == 'Unknown report delivery: email'
+    if importlib.util.find_spec('pyarrow') is None:
+        assert 'adding pyarrow to requirements.txt' in main.report_settings_problem('auto', 'parquet')
+    else:
+        assert main.report_settings_problem('auto', 'parquet') is None
+
+
+@pytest.mark.skipif(importlib.util.find_spec('pyarrow') is not None, reason='pyarrow is installed')
+def test_parquet_without_pyarrow_sends_inline_reports(monkeypatch, capsys, sendgrid):
+    monkeypatch.setenv('REPORT_ATTACHMENT_FORMAT', 'parquet')
+    try:
+        importlib.reload(main)
+        assert 'requires adding pyarrow to requirements.txt' in capsys.readouterr().out
+        rows = [{'users.name': 'user {}'.format(i)} for i in range(600)]
+        assert main.execute_job(execute_request(rows, 'row')).status_code == 200
+        message = sendgrid.messages[0]
+        assert attachments(message) == []
+        assert '<td>user 599</td>' in email_body(message)
+    finally:
+        monkeypatch.undo()
+        importlib.reload(main)
+
+
+@pytest.fixture
+def job_store(monkeypatch):
+    store = jobs.MemoryJobStore()
+    monkeypatch.setattr(jobs, '_job_store', store)
+    monkeypatch.setattr(jobs, '_job_queue', jobs.MemoryQueue())
+    return store
+
+
+def test_queued_job_is_kept_until_the_report_is_sent(sendgrid, usage, job_store):
+    rows = [{'users.name': 'user {}'.format(i)} for i in range(5)]
+    job_id = main.submit_job(execute_request(rows, 'row'))
+    sendgrid.error = RuntimeError('sendgrid 503')
+
+    with pytest.raises(RuntimeError):
+        main.process_queued_jobs()
+    assert job_store.load(job_id) is not None
+    assert len(job_store.load_progress(job_id)) == 5
+    assert usage.model_calls == 5
+
+    sendgrid.error = None
+    assert main.process_queued_jobs() == 1  # the failed job was queued again
+    assert len(sendgrid.messages) == 1
+    assert usage.model_calls == 5  # the retry only sent the report
+    assert job_store.load(job_id) is None
+    assert job_store.load_progress(job_id) == {}
+
+
+@pytest.mark.parametrize('status', [400, 401, 413])
+def test_rejected_report_drops_the_job(sendgrid, usage, job_store, status):
+    job_id = main.submit_job(execute_request([{'users.name': 'Ann'}], 'row'))
+    sendgrid.error = HTTPError(status, 'Rejected', b'', {})
+    assert main.process_queued_jobs() == 1
+    assert job_store.load(job_id) is None
+    assert job_store.load_progress(job_id) == {}
+
+
+def test_job_is_dropped_after_max_attempts(sendgrid, usage, job_store, monkeypatch):
+    monkeypatch.setattr(main, 'JOB_MAX_ATTEMPTS', 2)
+    job_id = main.submit_job(execute_request([{'users.name': 'Ann'}], 'row'))
+    sendgrid.error = HTTPError(503, 'Service Unavailable', b'', {})
+    for _ in range(2):
+        with pytest.raises(RuntimeError):
+            main.run_job(job_id)
+    main.run_job(job_id)
+    assert job_store.load(job_id) is None
+    assert usage.model_calls == 1
+
+
+def test_checkpoint_is_kept_until_the_report_is_sent(sendgrid, usage):
+    rows = [{'users.name': 'user {}'.format(i)} for i in range(5)]
+    request = execute_request(rows, 'row')
+    sendgrid.error = RuntimeError('sendgrid 503')
+    assert main.execute_job(request).status_code == 503
+    assert len(jobs.get_checkpoint_store().load_progress(jobs.run_id(request))) == 5
+
+    sendgrid.error = None
+    assert main.execute_job(request).status_code == 200
+    assert usage.model_calls == 5
+    assert jobs.get_checkpoint_store().load_progress(jobs.run_id(request)) == {}
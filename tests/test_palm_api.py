@@ -0,0 +1,234 @@
+import json
+import pytest
+import palm_api
+from benchmarks.fakes import FakeResponse
+from google.api_core import exceptions
+from model_types import MODEL_TYPES
+from palm_api import batch_row_prompt_template, build_prompt, initial_prompt_template, input_token_budget, iter_chunks, join_batch_replies, parse_batch_response, plan_reduce_batches
+from prediction_cache import MemoryCache, NullCache
+from row_encoding import ROW_ENCODINGS, estimate_tokens, get_columns
+from types import SimpleNamespace
+
+QUESTION = 'Which customers are most likely to churn?'
+
+
+@pytest.mark.parametrize('reply', [
+    '[{"row": 3, "answer": "yes"}, {"row": 4, "answer": "no"}]',
+    '```json\n[{"row": 3, "answer": "yes"},\n {"row": 4, "answer": "no"}]\n```',
+    'Here are the answers:\n```\n[{"row": 3, "answer": "yes"}, {"row": 4, "answer": "no"}]\n```\nLet me know!',
+])
+def test_parse_batch_response(reply):
+    assert parse_batch_response(reply, range(3, 5)) == {3: 'yes', 4: 'no'}
+
+
+@pytest.mark.parametrize('reply, expected', [
+    ('[{"row": 0, "answer": "a"}, {"row": 1, "answer": "b"}, {"row": 2, "ans', {0: 'a', 1: 'b'}),
+    ('[{"row": 0, "answer": "a"}, {"row": 1, "answer": "cut off', {0: 'a'}),
+    ('[{"row": 0, "answer": "a"}', {0: 'a'}),
+    ('[', {}),
+    ('I cannot answer that.', {}),
+    ('', {}),
+])
+def test_parse_truncated_batch_response(reply, expected):
+    assert parse_batch_response(reply, range(0, 3)) == expected
+
+
+def test_parse_batch_response_keeps_only_valid_rows():
+    reply = json.dumps([
+        {'row': 9, 'answer': 'outside the batch'},
+        {'row': -1, 'answer': 'negative'},
+        {'row': '2', 'answer': 'row number as text'},
+        {'row': 2},
+        {'row': 2, 'answer': None},
+        {'answer': 'no row'},
+        'not an object',
+        {'row': 2, 'answer': 42},
+        {'row': 2, 'answer': 'duplicate'},
+        {'row': 3, 'answer': 'first row of the batch'},
+    ])
+    assert parse_batch_response(reply, range(2, 4)) == {2: '42', 3: 'first row of the batch'}
+
+
+def test_plan_reduce_batches_leaves_a_trailing_summary_alone():
+    summaries = ['summary {}'.format(i) for i in range(11)]
+    assert plan_reduce_batches(summaries, 'text-bison', 10) == [(0, 10), (10, 11)]
+    assert plan_reduce_batches(summaries[:2], 'text-bison', 10) == [(0, 2)]
+    assert plan_reduce_batches([], 'text-bison', 10) == []
+
+
+@pytest.fixture
+def prompts(monkeypatch):
+    """Records reduce prompts, answering each with a summary numbered by call"""
+    prompts = []
+
+    def fake_prediction(model, model_type, content, *params):
+        prompts.append(content)
+        return FakeResponse('reduced {}'.format(len(prompts)))
+
+    monkeypatch.setattr(palm_api, 'get_model', lambda model_type: None)
+    monkeypatch.setattr(palm_api, 'model_prediction', fake_prediction)
+    return prompts
+
+
+@pytest.mark.parametrize('summaries, expected', [([], ''), (['only one'], 'only one')])
+def test_reduce_without_model_calls(prompts, summaries, expected):
+    assert palm_api.reduce(summaries, 'text-bison', 0.2, 1024, 40, 0.8) == expected
+    assert prompts == []
+
+
+def test_reduce_carries_single_summaries_to_the_next_level(prompts):
+    summaries = ['summary {}'.format(i) for i in range(11)]
+    assert palm_api.reduce(summaries, 'text-bison', 0.2, 1024, 40, 0.8, fan_in=10) == 'reduced 2'
+    assert len(prompts) == 2
+    assert 'summary 10' not in prompts[0]
+    assert 'reduced 1\nsummary 10' in prompts[1]
+
+
+def test_reduce_reuses_cached_predictions(prompts, monkeypatch):
+    monkeypatch.setattr(palm_api, 'prediction_cache', MemoryCache())
+    summaries = ['summary {}'.format(i) for i in range(11)]
+    assert palm_api.reduce(summaries, 'text-bison', 0.2, 1024, 40, 0.8, fan_in=10) == 'reduced 2'
+    assert palm_api.reduce(summaries, 'text-bison', 0.2, 1024, 40, 0.8, fan_in=10) == 'reduced 2'
+    assert len(prompts) == 2
+    palm_api.reduce(summaries, 'text-bison', 0.3, 1024, 40, 0.8, fan_in=10)
+    assert len(prompts) == 4  # a different temperature is a different prediction
+
+
+def test_batched_rerun_only_repeats_failed_single_row_prompts(monkeypatch):
+    rows = [{'u.name': 'name-{}'.format(i)} for i in range(4)]
+    failing = {'name-1'}
+    prompts = []
+
+    def fake_prediction(model, model_type, content, *params):
+        prompts.append(content)
+        if 'JSON array:' in content:
+            return FakeResponse('[{"row": 0, "answer": "batch answer"}]')
+        name = next(row['u.name'] for row in rows if row['u.name'] in content)
+        if name in failing:
+            raise RuntimeError('model unavailable')
+        return FakeResponse('answer for ' + name)
+
+    monkeypatch.setattr(palm_api, 'get_model', lambda model_type: None)
+    monkeypatch.setattr(palm_api, 'model_prediction', fake_prediction)
+    monkeypatch.setattr(palm_api, 'prediction_cache', NullCache())
+    checkpoint = {}
+
+    def run():
+        return palm_api.predict_rows_batched(
+            rows, QUESTION, 'text-bison', 0.2, 1024, 40, 0.8,
+            completed=dict(checkpoint), on_chunk_complete=checkpoint.__setitem__, tolerate_errors=True)
+
+    first = run()
+    assert len(prompts) == 4  # one batch, then rows 1 to 3 alone
+    assert first[0] == 'batch answer'
+    assert isinstance(first[1], palm_api.PredictionError)
+    assert first[2:] == ['answer for name-2', 'answer for name-3']
+
+    prompts.clear()
+    failing.clear()
+    assert run() == ['batch answer', 'answer for name-1', 'answer for name-2', 'answer for name-3']
+    assert len(prompts) == 1 and 'name-1' in prompts[0]
+
+
+def sample_rows(count, width=40):
+    rows = []
+    for i in range(count):
+        row = {'users.id': i, 'users.name': 'customer {} '.format(i) * (1 + i % 5),
+               'orders.total': round(i * 1.37, 2), 'users.note': 'x' * (width + i % 17)}
+        if i % 7 == 0:
+            row['users.state'] = 'CA'  # a column that only some rows have
+        rows.append(row)
+    return rows
+
+
+@pytest.mark.parametrize('model_type', list(MODEL_TYPES))
+@pytest.mark.parametrize('row_encoding', list(ROW_ENCODINGS))
+@pytest.mark.parametrize('template', [initial_prompt_template, batch_row_prompt_template])
+def test_chunks_fit_the_input_token_budget(model_type, row_encoding, template):
+    rows = sample_rows(600)
+    chunks = list(iter_chunks(rows, QUESTION, model_type,
+                  row_encoding=row_encoding, template=template))
+    assert len(chunks) > 1
+    for _, chunk in chunks:
+        prompt = build_prompt(QUESTION, chunk, row_encoding, get_columns(chunk), template)
+        assert estimate_tokens(prompt) <= input_token_budget(model_type)
+
+
+@pytest.mark.parametrize('max_rows', [None, 1, 3, 25])
+def test_chunks_cover_every_row_in_order(max_rows):
+    rows = sample_rows(200)
+    chunks = list(iter_chunks(iter(rows), QUESTION, 'text-bison', max_rows))
+    assert [row for _, chunk in chunks for row in chunk] == rows
+    starts = [start for start, _ in chunks]
+    assert starts == [sum(len(chunk) for _, chunk in chunks[:i]) for i in range(len(chunks))]
+    if max_rows is not None:
+        assert all(len(chunk) <= max_rows for _, chunk in chunks)
+
+
+def test_oversized_row_is_sent_alone():
+    rows = [{'a': 1}, {'a': 'y' * 40000}, {'a': 2}]
+    assert [chunk for _, chunk in iter_chunks(rows, QUESTION, 'text-bison')] == [
+        [rows[0]], [rows[1]], [rows[2]]]
+
+
+def test_no_rows_no_chunks():
+    assert list(iter_chunks([], QUESTION, 'text-bison')) == []
+
+
+def test_digits_count_one_token_each():
+    assert estimate_tokens('') == 0
+    assert estimate_tokens('abcd') == 2
+    assert estimate_tokens('1234.5') == 6
+
+
+@pytest.mark.parametrize('model_type', list(MODEL_TYPES))
+def test_numeric_chunks_leave_room_under_the_limit(model_type):
+    rows = [{'o.id': i, **{'o.measure_{}'.format(m): round(i * 7919.37 / (m + 1) % 10000, 2) for m in range(10)}}
+            for i in range(2000)]
+    for _, chunk in iter_chunks(rows, QUESTION, model_type):
+        prompt = build_prompt(QUESTION, chunk, 'columnar', get_columns(chunk))
+        digits = sum(map(prompt.count, '0123456789'))
+        # even if everything but the digits took one token per two characters
+        assert digits + (len(prompt) - digits + 1) // 2 <= MODEL_TYPES[model_type]['max_input_tokens']
+
+
+@pytest.fixture
+def rejecting(monkeypatch):
+    """Records prompts, rejecting any with more than `limit` rows as too long"""
+    model = SimpleNamespace(prompts=[], limit=2)
+
+    def fake_prediction(model_handle, model_type, content, *params):
+        model.prompts.append(content)
+        rows = content.count('name-')
+        if rows > model.limit:
+            raise exceptions.InvalidArgument('Prompt is too long')
+        return FakeResponse('answer for {} rows'.format(rows))
+
+    monkeypatch.setattr(palm_api, 'get_model', lambda model_type: None)
+    monkeypatch.setattr(palm_api, 'model_prediction', fake_prediction)
+    monkeypatch.setattr(palm_api, 'prediction_cache', NullCache())
+    return model
+
+
+def named_rows(count):
+    return [{'u.name': 'name-{}'.format(i)} for i in range(count)]
+
+
+def test_rejected_chunk_is_split_in_half(rejecting):
+    summaries = palm_api.model_with_limit_and_backoff(
+        named_rows(8), QUESTION, None, 'text-bison', 0.2, 1024, 40, 0.8)
+    assert summaries == ['\n'.join(['answer for 2 rows'] * 4)]
+    assert len(rejecting.prompts) == 7  # 8 rows, then 4 and 4, then four prompts of 2
+
+
+def test_split_stops_after_max_splits(rejecting):
+    rejecting.limit = 0
+    with pytest.raises(exceptions.InvalidArgument):
+        palm_api.model_with_limit_and_backoff(
+            named_rows(32), QUESTION, None, 'text-bison', 0.2, 1024, 40, 0.8)
+    assert len(rejecting.prompts) == palm_api.MAX_SPLITS + 1
+
+
+def test_split_batch_replies_are_joined():
+    replies = ['[{"row": 4, "answer": "a"}]', '```json\n[{"row": 5, "answer": "b"}, {"row": 4, "answer": "c"}]\n```']
+    assert parse_batch_response(join_batch_replies(replies), range(4, 6)) == {4: 'a', 5: 'b'}
@@ -0,0 +1,125 @@
+import pytest
+import prediction_cache
+from prediction_cache import LocalRedis, MemoryCache, NullCache, RedisCache, SQLiteCache, cache_key, create_cache
+
+
+class FakeClock:
+    """Stands in for the time module"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(prediction_cache, 'time', clock)
+    return clock
+
+
+def test_cache_key_covers_every_parameter():
+    key = cache_key('text-bison@001', 'prompt', 0.2, 1024, 40, 0.8)
+    assert key == cache_key('text-bison@001', 'prompt', 0.2, 1024, 40, 0.8)
+    assert len({key,
+                cache_key('code-bison@001', 'prompt', 0.2, 1024, 40, 0.8),
+                cache_key('text-bison@001', 'prompt!', 0.2, 1024, 40, 0.8),
+                cache_key('text-bison@001', 'prompt', 0.3, 1024, 40, 0.8),
+                cache_key('text-bison@001', 'prompt', 0.2, 512, 40, 0.8),
+                cache_key('text-bison@001', 'prompt', 0.2, 1024, 20, 0.8),
+                cache_key('text-bison@001', 'prompt', 0.2, 1024, 40, 0.9)}) == 7
+
+
+def test_memory_entries_expire(clock):
+    cache = MemoryCache(ttl=60)
+    cache.set_many({'a': 'x'})
+    clock.now += 60
+    assert cache.get_many(['a', 'b']) == {'a': 'x'}
+    clock.now += 1
+    assert cache.get_many(['a']) == {}
+
+
+def test_memory_evicts_least_recently_used(clock):
+    cache = MemoryCache(max_entries=2)
+    cache.set_many({'a': '1', 'b': '2'})
+    cache.get_many(['a'])  # b is now the least recently used
+    cache.set_many({'c': '3'})
+    assert cache.get_many(['a', 'b', 'c']) == {'a': '1', 'c': '3'}
+
+
+def test_sqlite_entries_expire(clock, tmp_path):
+    cache = SQLiteCache(str(tmp_path / 'cache.sqlite3'), ttl=60)
+    cache.set_many({'a': 'x'})
+    clock.now += 61
+    assert cache.get_many(['a']) == {}
+    cache.set_many({'b': 'y'})  # writes also remove expired rows
+    assert cache._db.execute('SELECT key FROM predictions').fetchall() == [('b',)]
+
+
+def test_sqlite_evicts_least_recently_used(clock, tmp_path):
+    path = str(tmp_path / 'cache.sqlite3')
+    cache = SQLiteCache(path, max_entries=2)
+    cache.set_many({'a': '1'})
+    clock.now += 1
+    cache.set_many({'b': '2'})
+    clock.now += 1
+    cache.get_many(['a'])  # marks a as used after b
+    clock.now += 1
+    cache.set_many({'c': '3'})
+    assert cache.get_many(['a', 'b', 'c']) == {'a': '1', 'c': '3'}
+    # entries survive a new connection, as on the next request of a warm instance
+    assert SQLiteCache(path).get_many(['a', 'c']) == {'a': '1', 'c': '3'}
+
+
+def test_sqlite_looks_up_more_keys_than_one_query_binds(tmp_path):
+    cache = SQLiteCache(str(tmp_path / 'cache.sqlite3'))
+    items = {'key {}'.format(i): 'value {}'.format(i) for i in range(1200)}
+    cache.set_many(items)
+    assert cache.get_many(list(items)) == items
+
+
+class BytesRedis(LocalRedis):
+    """Returns values as bytes, as the Redis client does without decode_responses"""
+
+    def __init__(self):
+        super().__init__()
+        self.pipelines = 0
+
+    def mget(self, keys):
+        return [None if value is None else value.encode('utf-8') for value in super().mget(keys)]
+
+    def pipeline(self, transaction=True):
+        self.pipelines += 1
+        return super().pipeline(transaction)
+
+
+def test_redis_decodes_bytes_and_writes_in_one_pipeline():
+    client = BytesRedis()
+    cache = RedisCache(client, ttl=60)
+    cache.set_many({'a': 'ünïcode', 'b': 'y'})
+    cache.set_many({})
+    assert client.pipelines == 1
+    assert cache.get_many(['a', 'b', 'c']) == {'a': 'ünïcode', 'b': 'y'}
+    assert cache.get_many([]) == {}
+    assert client.mget(['vertex-ai-actions:prediction:a']) == ['ünïcode'.encode('utf-8')]
+
+
+def test_local_redis_expires_values(clock):
+    client = LocalRedis()
+    client.set('a', 'x', ex=60)
+    client.pipeline().set('b', 'y').set('c', 'z', ex=120).execute()
+    clock.now += 61
+    assert client.mget(['a', 'b', 'c']) == [None, 'y', 'z']
+
+
+@pytest.mark.parametrize('backend, cache_type', [
+    ('memory', MemoryCache), ('local-redis', RedisCache), ('none', NullCache)])
+def test_create_cache(backend, cache_type):
+    assert isinstance(create_cache(backend), cache_type)
+
+
+def test_unknown_cache_backend():
+    with pytest.raises(ValueError):
+        create_cache('carrier-pigeon')
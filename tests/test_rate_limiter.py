@@ -0,0 +1,98 @@
+import pytest
+import rate_limiter
+from rate_limiter import AdaptiveRateLimiter, FileBucketState, create_bucket_state
+
+
+class FakeClock:
+    """Stands in for the time module. sleep only advances the clock when `advance` is set."""
+
+    def __init__(self, advance=False):
+        self.now = 1000.0
+        self.advance = advance
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        if self.advance:
+            self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limiter, 'time', clock)
+    return clock
+
+
+def test_burst_then_one_reservation_per_slot(clock):
+    limiter = AdaptiveRateLimiter(60, 60, burst=2)
+    # callers arriving together each reserve the next free slot
+    assert [limiter.acquire() for _ in range(5)] == pytest.approx([0, 0, 1, 2, 3])
+    assert clock.slept == pytest.approx([1, 2, 3])
+
+
+def test_paced_caller_waits_one_interval(clock):
+    clock.advance = True
+    limiter = AdaptiveRateLimiter(30, 60)
+    waits = [limiter.acquire() for _ in range(4)]
+    assert waits == pytest.approx([0, 2, 2, 2])
+    assert clock.now == pytest.approx(1006)
+
+
+def test_idle_time_refills_up_to_burst(clock):
+    limiter = AdaptiveRateLimiter(60, 60, burst=3)
+    for _ in range(3):
+        limiter.acquire()
+    clock.now += 100
+    assert [limiter.acquire() for _ in range(4)] == pytest.approx([0, 0, 0, 1])
+
+
+def test_throttle_decreases_once_per_cooldown(clock):
+    limiter = AdaptiveRateLimiter(60, 60, decrease=0.5, cooldown=10, min_rate=10)
+    assert limiter.on_throttle() == 30
+    clock.now += 5
+    assert limiter.on_throttle() == 30  # same burst of throttling
+    clock.now += 5
+    assert limiter.on_throttle() == 15
+    clock.now += 10
+    assert limiter.on_throttle() == 10  # never below min_rate
+    assert limiter.current_rate() == 10
+
+
+def test_throttled_rate_spaces_reservations(clock):
+    limiter = AdaptiveRateLimiter(60, 60)
+    limiter.acquire()
+    limiter.on_throttle()
+    # tokens now refill at 30 per minute, one every 2s
+    clock.now += 1
+    assert limiter.acquire() == pytest.approx(1)
+    clock.now += 1
+    assert limiter.acquire() == pytest.approx(2)
+
+
+def test_success_recovers_towards_max_rate(clock):
+    limiter = AdaptiveRateLimiter(20, 60, increase=1)
+    limiter.on_throttle()
+    assert limiter.current_rate() == 10
+    assert limiter.on_success() == pytest.approx(10.1)
+    for _ in range(1000):
+        limiter.on_success()
+    assert limiter.current_rate() == 20
+
+
+def test_file_state_is_shared_between_limiters(clock, tmp_path):
+    path = str(tmp_path / 'bucket.json')
+    first = AdaptiveRateLimiter(60, 60, FileBucketState(path))
+    second = AdaptiveRateLimiter(60, 60, FileBucketState(path))
+    assert first.acquire() == 0
+    assert second.acquire() == pytest.approx(1)
+    first.on_throttle()
+    assert second.current_rate() == 30
+
+
+def test_unknown_bucket_state():
+    with pytest.raises(ValueError):
+        create_bucket_state('carrier-pigeon')
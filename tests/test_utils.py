@@ -0,0 +1,207 @@
+import io
+import json
+import pytest
+from types import SimpleNamespace
+from utils import cached_json_response, dedupe_rows, etag, iter_json_rows, list_to_html, project_rows, sanitize_and_load_json_str
+
+ROWS = [
+    {'users.name': 'Ann', 'users.id': 1, 'orders.total': 12.5},
+    {'users.name': 'Bob [admin]', 'users.id': 22, 'orders.total': -3},
+    {'users.name': 'say {hi}, "ok"', 'users.id': 333, 'orders.total': None},
+    {'users.name': 'Zoë', 'users.id': 4444, 'orders.total': 1e-05, 'users.tags': [1, True, False]},
+]
+
+
+@pytest.mark.parametrize('read_size', [1, 2, 3, 7, 1 << 16])
+def test_rows_match_json_loads(read_size):
+    text = json.dumps(ROWS)
+    assert list(iter_json_rows(text, read_size=read_size)) == ROWS
+
+
+@pytest.mark.parametrize('read_size', [1, 5])
+def test_reads_file_objects(read_size):
+    source = io.StringIO(json.dumps(ROWS, indent=2))
+    assert list(iter_json_rows(source, read_size=read_size)) == ROWS
+
+
+@pytest.mark.parametrize('read_size', [1, 2, 4])
+def test_numbers_split_across_reads(read_size):
+    assert list(iter_json_rows('[1, 23, 456 ,7890]', read_size=read_size)) == [1, 23, 456, 7890]
+
+
+@pytest.mark.parametrize('text', ['[]', ' [ ] ', '[\n]'])
+def test_empty_array(text):
+    assert list(iter_json_rows(text, read_size=1)) == []
+
+
+@pytest.mark.parametrize('text', ['', '{"a": 1}', '[{"a": 1},'])
+def test_invalid_input_raises(text):
+    with pytest.raises(json.JSONDecodeError):
+        list(iter_json_rows(text, read_size=2))
+
+
+@pytest.mark.parametrize('read_size', [1, 3, 8, 1 << 16])
+@pytest.mark.parametrize('text, expected', [
+    ('[{"u.name": "say "hi" now", "u.id": 1}]',
+     [{'u.name': 'say "hi" now', 'u.id': 1}]),
+    ('[{"u.name": "12" monitor"}, {"u.name": "plain"}]',
+     [{'u.name': '12" monitor'}, {'u.name': 'plain'}]),
+    ('[{"u.name": "ends with "quote""}]',
+     [{'u.name': 'ends with "quote"'}]),
+    ('[["x "y" z", 1]]',
+     [['x "y" z', 1]]),
+    ('[{"u.name": "Smith", "John", "u.id": 1}, {"u.name": "Lee", "u.id": 2}]',
+     [{'u.name': 'Smith", "John', 'u.id': 1}, {'u.name': 'Lee', 'u.id': 2}]),
+    ('[{"p.size": "size "L", "XL" only", "p.id": 2}]',
+     [{'p.size': 'size "L", "XL" only', 'p.id': 2}]),
+    ('[{"e.payload": "{"a": "b"}", "e.id": 1}, {"e.payload": "[1, "x"]", "e.id": 2}]',
+     [{'e.payload': '{"a": "b"}', 'e.id': 1}, {'e.payload': '[1, "x"]', 'e.id': 2}]),
+    ('[{"e.note": "ends with "quote"}", "e.id": 1}]',
+     [{'e.note': 'ends with "quote"}', 'e.id': 1}]),
+    ('[{"v.f0": "aa": :"},{"v.f0": "a., : "}]',
+     [{'v.f0': 'aa": :'}, {'v.f0': 'a., : '}]),
+])
+def test_repairs_unescaped_quotes(text, expected, read_size):
+    assert list(iter_json_rows(text, read_size=read_size)) == expected
+
+
+def test_repair_only_touches_damaged_rows():
+    text = '[{"a": "ok"}, {"a": "5" tall"}, {"a": "fine \\"escaped\\""}]'
+    assert sanitize_and_load_json_str(text) == [
+        {'a': 'ok'}, {'a': '5" tall'}, {'a': 'fine "escaped"'}]
+
+
+def escape_quotes_and_load(text):
+    """The loader from before the streaming parser, which escaped the quote before each parse error"""
+    prev_pos = -1
+    curr_pos = 0
+    while True:
+        try:
+            return json.loads(text, strict=False)
+        except json.JSONDecodeError as err:
+            prev_pos, curr_pos = curr_pos, err.pos
+            if curr_pos <= prev_pos:
+                raise
+            quote = text.rfind('"', 0, curr_pos)
+            text = text[:quote] + '\\' + text[quote:]
+
+
+@pytest.mark.parametrize('read_size', [1, 4, 1 << 16])
+@pytest.mark.parametrize('text', [
+    '[{"a": 1} {"a": 2}]',
+    '[{"v.f0": ""},:}] ", "v.f1": "].", "v.f2": """,{} :"}]',
+    '[{"v.f0": "bb{"}, {"v.f0": ":]: {", "v.f1": "}"},[["}]',
+    '[{"v.f0": " "ba,", "v.f1": ":" ,":":"}, {"v.f0": ""a."}]',
+    '[{"v.f0": ""}],a"}, {"v.f0": " ,[a::,[", "v.id": 1}]',
+])
+def test_loads_what_the_old_loader_loaded(text, read_size):
+    # the repair cannot place these quotes, so the rest is loaded as it was before
+    assert list(iter_json_rows(text, read_size=read_size)) == escape_quotes_and_load(text)
+
+
+TABLES = [
+    [{'u.name': 'Ann <admin> & co', 'u.id': 1}, {'u.name': 'Bob', 'u.id': 2}],
+    [{'o.total': 0.1 + 0.2}, {'o.total': 12.3456789}],
+    [{'o.total': 1}, {'o.total': 2.5}, {'o.total': None}],
+    [{'o.total': 1.0}, {'o.total': 2.0}, {'o.total': -0.5}],
+    [{'o.total': 1234567.5}, {'o.total': 1.0}],
+    [{'o.total': 123456789.25}, {'o.total': 1.0}],
+    [{'o.total': 1e-07}, {'o.total': 1.0}],
+    [{'o.total': float('nan')}, {'o.total': float('inf')}, {'o.total': -2.25}],
+    [{'o.count': 1}, {'o.count': 3}],
+    [{'o.count': 1}, {'u.name': 'no count'}],
+    [{'u.active': True}, {'u.active': None}],
+    [{'u.name': 'x'}, {'u.name': 1.5}, {'u.name': None}],
+]
+
+
+@pytest.mark.parametrize('rows', TABLES)
+def test_html_table_matches_pandas(rows):
+    pd = pytest.importorskip('pandas')
+    assert list_to_html(rows) == pd.DataFrame(data=rows).to_html().replace('\n', '')
+
+
+def test_html_table_formats_floats_like_pandas():
+    table = list_to_html([{'a': 0.1 + 0.2, 'b': 1.5}, {'a': 12.3456789, 'b': 2.0}])
+    assert '<td>0.300000</td>      <td>1.5</td>' in table
+    assert '<td>12.345679</td>      <td>2.0</td>' in table
+
+
+def test_html_table_keeps_line_breaks():
+    table = list_to_html([{'prompt_result': '\n- one\n- two <b>\n'}])
+    assert '<td>- one<br>- two &lt;b&gt;</td>' in table
+
+
+BODY = '[{"name": "question"}]'
+
+
+@pytest.mark.parametrize('if_none_match', [
+    etag(BODY),
+    'W/' + etag(BODY),
+    '"stale", ' + etag(BODY),
+    '"stale",W/' + etag(BODY),
+    '*',
+    ' * ',
+])
+def test_cached_json_response_not_modified(if_none_match):
+    request = SimpleNamespace(headers={'If-None-Match': if_none_match})
+    response = cached_json_response(request, BODY, etag(BODY), 'private, no-cache')
+    assert response.status_code == 304
+    assert response.get_data() == b''
+    assert response.headers['ETag'] == etag(BODY)
+    assert response.headers['Cache-Control'] == 'private, no-cache'
+
+
+@pytest.mark.parametrize('headers', [
+    {},
+    {'If-None-Match': ''},
+    {'If-None-Match': '"stale"'},
+    {'If-None-Match': etag(BODY)[1:-1]},  # unquoted
+    {'If-None-Match': etag(BODY + ' ')},
+])
+def test_cached_json_response_sends_the_body(headers):
+    response = cached_json_response(SimpleNamespace(headers=headers), BODY, etag(BODY), 'private, max-age=300')
+    assert response.status_code == 200
+    assert response.get_data(as_text=True) == BODY
+    assert response.mimetype == 'application/json'
+    assert response.headers['ETag'] == etag(BODY)
+    assert response.headers['Cache-Control'] == 'private, max-age=300'
+
+
+ROWS = [
+    {'users.name': 'Ann', 'users.state': 'CA', 'orders.count': 1},
+    {'users.name': 'Bob', 'users.state': 'NY', 'orders.count': 2},
+    {'users.name': 'Cy', 'users.state': 'CA', 'orders.count': 3},
+    {'users.name': 'Di', 'orders.count': 4},
+    {'users.name': 'Ed', 'users.state': 'CA', 'orders.count': 5},
+]
+
+
+@pytest.mark.parametrize('columns, expected', [
+    (None, ROWS),
+    ([], ROWS),
+    (['users.state'], [{'users.state': row.get('users.state')} for row in ROWS]),
+    (['users.state', 'users.missing'], [{'users.state': row.get('users.state')} for row in ROWS]),
+    # none of the fields exist, so the model still gets the data
+    (['users.missing', 'orders.total'], ROWS),
+])
+def test_project_rows(columns, expected):
+    assert list(project_rows(iter(ROWS), columns)) == expected
+    assert list(project_rows([], columns)) == []
+
+
+def test_dedupe_rows_fans_out_through_positions():
+    projected = list(project_rows(ROWS, ['users.state']))
+    distinct, positions = dedupe_rows(iter(projected))
+    assert positions == []  # filled in as the rows are consumed
+    distinct = list(distinct)
+    assert distinct == [{'users.state': 'CA'}, {'users.state': 'NY'}, {'users.state': None}]
+    assert positions == [0, 1, 0, 2, 0]
+    assert [distinct[i] for i in positions] == projected
+
+
+def test_dedupe_rows_ignores_key_order_but_not_types():
+    rows = [{'a': 1, 'b': 2}, {'b': 2, 'a': 1}, {'a': '1', 'b': 2}, {'a': 1.0, 'b': 2}]
+    distinct, positions = dedupe_rows(rows)
+    assert list(distinct) == [rows[0], rows[2], rows[3]]
+    assert positions == [0, 0, 1, 2]
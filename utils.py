@@ -1,8 +1,16 @@
+import csv
+import gzip
+import hashlib
 import hmac
+import html
+import io
 import json
+import math
 import os
-import pandas as pd
+import re
+from typing import Iterable, Iterator
 from flask import Response
+from row_encoding import get_columns
 
 
 # https://github.com/looker-open-source/actions/blob/master/docs/action_api.md#authentication
@@ -31,6 +39,21 @@ def handle_error(message, status):
     return Response(json.dumps(response), status=status, mimetype='application/json')
 
 
+def etag(body: str) -> str:
+    """Returns a strong ETag for a response body"""
+    return '"{}"'.format(hashlib.sha256(body.encode('utf-8')).hexdigest()[:32])
+
+
+def cached_json_response(request, body: str, body_etag: str, cache_control: str):
+    """Returns a JSON response with caching headers, or an empty 304 if the client already has body_etag"""
+    headers = {'ETag': body_etag, 'Cache-Control': cache_control}
+    if_none_match = request.headers.get('If-None-Match', '')
+    if if_none_match.strip() == '*' or body_etag in (
+            tag.strip().removeprefix('W/') for tag in if_none_match.split(',')):
+        return Response(status=304, headers=headers)
+    return Response(body, status=200, mimetype='application/json', headers=headers)
+
+
 def safe_cast(input, to_type, min, max, default):
     """Casts form input values to correct type and returns default if invalid"""
     try:
@@ -44,23 +67,370 @@ def safe_cast(input, to_type, min, max, default):
 
 
 def sanitize_and_load_json_str(s: str, strict=False):
-    json_string = s
+    """Loads a JSON array of rows, repairing unescaped quotes inside strings"""
+    return list(iter_json_rows(s, strict))
+
+
+def project_rows(rows: Iterable, columns: list | None) -> Iterator[dict]:
+    """Yields rows reduced to the given columns, or unchanged if none of the columns are in the results"""
+    rows = iter(rows)
+    first = next(rows, None)
+    if first is None:
+        return
+    if columns:
+        missing = [column for column in columns if column not in first]
+        if missing:
+            print('Ignoring fields not in the results: {}'.format(', '.join(missing)))
+        columns = [column for column in columns if column in first]
+    if not columns:
+        yield first
+        yield from rows
+        return
+    yield {column: first[column] for column in columns}
+    for row in rows:
+        yield {column: row.get(column) for column in columns}
+
+
+def dedupe_rows(rows: Iterable) -> tuple[Iterator[dict], list]:
+    """Returns an iterator over the distinct rows and a list, filled in as it is consumed, mapping each row to its distinct row"""
+    positions = []
+
+    def distinct():
+        seen = {}
+        for row in rows:
+            key = json.dumps(row, sort_keys=True, default=str)
+            if key in seen:
+                positions.append(seen[key])
+                continue
+            seen[key] = len(seen)
+            positions.append(seen[key])
+            yield row
+
+    return distinct(), positions
+
+
+def _html_cell(value) -> str:
+    """Formats a table cell like pandas to_html: escaped and stripped, with line breaks kept as <br>"""
+    return html.escape(str(value), quote=False).strip().replace('\n', '<br>')
+
+
+FLOAT_DIGITS = 6  # Decimals shown for floats, pandas' default display.precision
+
+
+def _float_formatter(rows: list, column: str):
+    """Returns a function formatting the cells of a float column the way pandas to_html did, or None"""
+    numbers = 0
+    gaps = False
+    has_float = False
+    trim = FLOAT_DIGITS - 1  # at least one decimal is kept
+    longest = other = 0  # widest number, and widest NaN or inf, which are not trimmed
+    small = large = False
+    for row in rows:
+        value = row.get(column)
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            gaps = True
+            other = max(other, len('NaN'))
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            return None
+        numbers += 1
+        has_float = has_float or isinstance(value, float)
+        text = '{: .{}f}'.format(value, FLOAT_DIGITS)  # width counts a sign or a space, as pandas did
+        if math.isfinite(value):
+            trim = min(trim, len(text) - len(text.rstrip('0')))
+            small = small or 0 < abs(value) < 10 ** -FLOAT_DIGITS
+            large = large or abs(value) > 1e6
+            longest = max(longest, len(text))
+        else:
+            other = max(other, len(text))
+    if not numbers or not (has_float or gaps):
+        return None
+    if small or (large and max(longest - trim, other) > FLOAT_DIGITS + 6):
+        number_format = '{{:.{}e}}'.format(FLOAT_DIGITS)
+    else:
+        number_format = '{{:.{}f}}'.format(FLOAT_DIGITS - trim)
+
+    def format_float(value):
+        if value is None or math.isnan(value):
+            return 'NaN'
+        return number_format.format(value)
+    return format_float
+
+
+def iter_html_table(rows: list, columns: list | None = None) -> Iterator[str]:
+    """Yields an HTML table of rows piece by piece, in the layout pandas DataFrame.to_html used"""
+    if columns is None:
+        columns = get_columns(rows)
+    formatters = [_float_formatter(rows, column) for column in columns]
+    yield '<table border="1" class="dataframe">  <thead>    <tr style="text-align: right;">      <th></th>'
+    for column in columns:
+        yield '      <th>{}</th>'.format(_html_cell(column))
+    yield '    </tr>  </thead>  <tbody>'
+    for i, row in enumerate(rows):
+        yield '    <tr>      <th>{}</th>'.format(i)
+        yield ''.join('      <td>{}</td>'.format(_html_cell(
+            row.get(column, 'NaN') if formatter is None else formatter(row.get(column))))
+            for column, formatter in zip(columns, formatters))
+        yield '    </tr>'
+    yield '  </tbody></table>'
+
+
+def list_to_html(list, columns=None):
+    return ''.join(iter_html_table(list, columns))
+
+
+def rows_to_csv_gz(rows: Iterable, columns: list) -> bytes:
+    """Writes rows as gzip compressed CSV with a header row, one row at a time"""
+    buffer = io.BytesIO()
+    with gzip.open(buffer, 'wt', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(['' if row.get(column) is None else row.get(column)
+                             for column in columns])
+    return buffer.getvalue()
+
+
+def rows_to_parquet(rows: Iterable, columns: list) -> bytes:
+    """Writes rows as a Parquet file with compressed columns"""
+    import pyarrow as pa  # optional dependency, only needed for parquet attachments
+    import pyarrow.parquet as pq
+    table = pa.Table.from_pylist([{column: row.get(column) for column in columns} for row in rows])
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression='zstd')
+    return buffer.getvalue()
+
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+_STRING_SPECIAL = re.compile(r'["\\]')
+_STRUCTURAL = re.compile(r'["{}\[\]:,]')
+_VALUE_START = set('"{[-0123456789tfn')
+
+
+def _value_ends(buf: str, j: int, stack: list, depth: int, eof: bool):
+    """Decides if a value in stack[depth] can end just before buf[j], or None if buf ends too soon"""
+    while True:
+        j = _WHITESPACE.match(buf, j).end()
+        if j >= len(buf):
+            return True if eof else None
+        char = buf[j]
+        if depth >= 0 and char == ('}' if stack[depth][0] == '{' else ']'):
+            depth -= 1
+            j += 1
+            continue
+        if char == ']' and depth < 0:
+            # the last row, so only whitespace may follow
+            k = _WHITESPACE.match(buf, j + 1).end()
+            if k < len(buf):
+                return False
+            return True if eof else None
+        if char != ',':
+            return False
+        k = _WHITESPACE.match(buf, j + 1).end()
+        if k >= len(buf):
+            return False if eof else None
+        if depth < 0 or stack[depth][0] == '[':
+            return buf[k] in _VALUE_START
+        # object members always start with a key followed by a colon
+        key_end = buf.find('"', k + 1) if buf[k] == '"' else -2
+        if key_end == -2:
+            return False
+        if key_end == -1:
+            return False if eof else None
+        m = _WHITESPACE.match(buf, key_end + 1).end()
+        if m >= len(buf):
+            return False if eof else None
+        return buf[m] == ':'
+
+
+def _closes_string(buf: str, i: int, stack: list, eof: bool):
+    """Decides if the quote at buf[i] ends its string, or None if buf ends too soon"""
+    container, expecting = stack[-1]
+    if container == '{' and expecting == 'key':
+        j = _WHITESPACE.match(buf, i + 1).end()
+        if j >= len(buf):
+            return True if eof else None
+        return buf[j] == ':'
+    return _value_ends(buf, i + 1, stack, len(stack) - 1, eof)
+
+
+def _repair_value(buf: str, pos: int, eof: bool):
+    """Copies the object or array at buf[pos], escaping quotes that cannot end a string, and returns it with the next position"""
+    pieces = []
+    stack = []
+    piece_start = pos
+    i = pos
+    while True:
+        match = _STRUCTURAL.search(buf, i)
+        if match is None:
+            return None
+        i = match.start()
+        char = buf[i]
+        if char == '"':
+            i += 1
+            while True:  # inside a string
+                match = _STRING_SPECIAL.search(buf, i)
+                if match is None:
+                    return None
+                i = match.start()
+                if buf[i] == '\\':
+                    i += 2
+                    continue
+                closes = _closes_string(buf, i, stack, eof)
+                if closes is None:
+                    return None
+                if closes:
+                    i += 1
+                    break
+                pieces.append(buf[piece_start:i])
+                pieces.append('\\')
+                piece_start = i
+                i += 1
+            continue
+        if char == ':':
+            stack[-1][1] = 'value'
+        elif char == ',':
+            stack[-1][1] = 'key' if stack[-1][0] == '{' else 'value'
+        elif char in '{[':
+            stack.append([char, 'key' if char == '{' else 'value'])
+        elif stack:
+            stack.pop()
+        i += 1
+        if not stack:
+            pieces.append(buf[piece_start:i])
+            return ''.join(pieces), i
+
+
+def _escape_quotes_and_load(text: str, strict=False):
+    """Loads JSON by escaping the quote before each parse error until it loads"""
     prev_pos = -1
     curr_pos = 0
-    while curr_pos > prev_pos:
-        prev_pos = curr_pos
+    while True:
         try:
-            return json.loads(json_string, strict=strict)
+            return json.loads(text, strict=strict)
         except json.JSONDecodeError as err:
-            curr_pos = err.pos
+            prev_pos, curr_pos = curr_pos, err.pos
             if curr_pos <= prev_pos:
                 raise err
-            prev_quote_index = json_string.rfind('"', 0, curr_pos)
-            json_string = json_string[:prev_quote_index] + \
-                "\\" + json_string[prev_quote_index:]
+            prev_quote_index = text.rfind('"', 0, curr_pos)
+            text = text[:prev_quote_index] + '\\' + text[prev_quote_index:]
+
+
+def _string_reader(text: str):
+    """Returns a read() function over text, so strings are parsed through the same bounded buffer as files"""
+    offset = 0
+
+    def read(size):
+        nonlocal offset
+        data = text[offset:offset + size]
+        offset += size
+        return data
+    return read
+
+
+def iter_json_rows(source, strict=False, read_size=1 << 16):
+    """Yields the rows of a JSON array from a string or file-like object, repairing unescaped quotes"""
+    decoder = json.JSONDecoder(strict=strict)
+    reader = source.read if hasattr(source, 'read') else _string_reader(source)
+    buf = ''
+    eof = False
+    pos = 0
+
+    def more():
+        nonlocal buf, pos, eof
+        data = reader(read_size)
+        if data:
+            buf = buf[pos:] + data
+            pos = 0
+        else:
+            eof = True
+
+    def next_char():
+        nonlocal pos
+        while True:
+            pos = _WHITESPACE.match(buf, pos).end()
+            if pos < len(buf):
+                return buf[pos]
+            if eof:
+                raise json.JSONDecodeError('Expecting value', buf, pos)
+            more()
 
+    def skip(offset):
+        """Returns the offset from pos of the first non-whitespace character at or after pos + offset, reading more as needed"""
+        while True:
+            i = _WHITESPACE.match(buf, pos + offset).end()
+            if i < len(buf) or eof:
+                return i - pos
+            offset = i - pos
+            more()
 
-def list_to_html(list):
-    df = pd.DataFrame(data=list)
-    table = df.to_html()
-    return table.replace('\n', '')
+    if next_char() != '[':
+        raise json.JSONDecodeError('Expecting a JSON array', buf, pos)
+    pos += 1
+    if next_char() == ']':
+        return
+    held = None  # the last row and its text, kept back so the fallback can read it again
+    while True:
+        while True:
+            try:
+                row, end = decoder.raw_decode(buf, pos)
+                # a number is only complete once a delimiter follows it
+                if eof or buf[pos] in '{["' or (end < len(buf) and buf[end] in ' \t\n\r,]'):
+                    break
+            except json.JSONDecodeError:
+                repaired = _repair_value(
+                    buf, pos, eof) if buf[pos] in '{[' else None
+                if repaired is not None:
+                    text, end = repaired
+                    try:
+                        row = json.loads(text, strict=strict)
+                    except json.JSONDecodeError:
+                        end = None  # the repair misread where the row ends
+                    break
+                if eof:
+                    end = None
+                    break
+            more()
+        loaded = end is not None
+        if loaded:
+            # the row must be followed by another row or by the end of the array
+            end = _WHITESPACE.match(buf, end).end() - pos
+            after = _WHITESPACE.match(buf, pos + end + 1).end() - pos
+            if pos + after >= len(buf):
+                end = skip(end)  # offsets from pos stay valid when more is read
+                after = skip(end + 1)
+            char = buf[pos + end:pos + end + 1]
+            if char == ']' and pos + after == len(buf):
+                after = None
+            elif char != ',' or pos + after == len(buf) or buf[pos + after] not in _VALUE_START:
+                end = None
+        if end is None:
+            while not eof:
+                more()
+            rest = buf[pos:]
+            try:
+                rows = _escape_quotes_and_load('[' + rest, strict)
+            except json.JSONDecodeError as err:
+                rows, error = None, err
+            if rows is None and held is not None:
+                # the last row may have loaded but taken some of this one with it
+                try:
+                    rows = _escape_quotes_and_load('[' + held[1] + rest, strict)
+                    held = None
+                except json.JSONDecodeError:
+                    pass
+            if held is not None:
+                yield held[0]
+            if rows is None:
+                if loaded:
+                    yield row  # e.g. the input is cut off after it
+                raise error
+            yield from rows
+            return
+        if held is not None:
+            yield held[0]
+        if after is None:
+            yield row
+            return
+        held = row, buf[pos:pos + end + 1]
+        pos += after